@@ -1,6 +1,47 @@
 from __future__ import absolute_import
 
-from .api import API, APIException
+from types import ModuleType
+
+import sys
+
 from ._version import __version__
 
-__all__ = ['API', 'APIException']
+# Exported names by submodule, imported on first use so that `import portal`
+# (and with it the CLI) starts without loading urllib2, cookielib and the like
+_EXPORTS = {
+    'api': ('API', 'APIException'),
+    'asyncapi': ('AsyncAPI', 'gather'),
+    'bulk': ('BulkResult', ),
+    'cache': ('DiskCache', ),
+    'localindex': ('LocalIndex', ),
+    'manifest': ('ProfileManifest', ),
+    'mirror': ('Mirror', ),
+    'records': ('AppId', 'CertRequest', 'Device', 'Profile', 'Record'),
+    'scheduler': ('Scheduler', ),
+    'trace': ('ChromeTrace', 'Event', 'LatencyStats'),
+    'transport': ('ConnectionPool', ),
+}
+
+_MODULES = dict((name, module) for module, names in _EXPORTS.items()
+                for name in names)
+
+__all__ = sorted(_MODULES)
+
+class _Module(ModuleType):
+    def __getattr__(self, name):
+        module = _MODULES.get(name)
+        if module is None:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        value = getattr(__import__('%s.%s' % (__name__, module),
+                                   fromlist=[ name ]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_MODULES))
+
+# Keep the original module alive, its functions use its globals
+_original = sys.modules[__name__]
+_module = sys.modules[__name__] = _Module(__name__)
+_module.__dict__.update(_original.__dict__)
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
+from collections import Mapping
 from functools import wraps
 
 import cookielib
-import HTMLParser
+import errno
+import hashlib
 import json
 import os
 import sys
 import re
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
-import uuid
+
+from . import jsonstream
+from . import records
+from . import sync
+from . import trace
+from .bulk import execute as bulk_execute
+from .scheduler import Scheduler
+from .transport import ConnectionPool, pooled_handlers
 
 def cached(wrapped):
     @wraps(wrapped)
@@ -29,13 +40,82 @@ def cached_method(wrapped):
         return getattr(self, name)
     return wrapper
 
+# Parsed .portalrc files by (home, working directory)
+_portalrc_cache = {}
+
+def _portalrc():
+    # ~/.portalrc, then the nearest one up from the working directory
+    def search_path():
+        yield os.path.expanduser('~/.portalrc')
+        path = os.getcwd()
+        while True:
+            filename = os.path.join(path, '.portalrc')
+            if os.path.isfile(filename):
+                yield filename
+                break
+            if path == '/':
+                break
+            path = os.path.dirname(path)
+
+    key = (os.path.expanduser('~'), os.getcwd())
+    cfg = _portalrc_cache.get(key)
+    if cfg is None:
+        import ConfigParser
+        cfg = ConfigParser.RawConfigParser()
+        cfg.read(search_path())
+        _portalrc_cache[key] = cfg
+    return cfg
+
+def portalrc_environments():
+    # Sections of the .portalrc files, as used by API(environment=...)
+    return _portalrc().sections()
+
+def _uuid4():
+    # uuid loads ctypes and libuuid, only worth it once a request is made
+    import uuid
+    return uuid.uuid4()
+
+@cached
+def _login_html_parser():
+    # Only needed when there is no session to reuse
+    import HTMLParser
+
+    class LoginHTMLParser(HTMLParser.HTMLParser):
+        url = None
+
+        def handle_starttag(self, tag, attrs):
+            if tag == "form":
+                attrs = { k: v for k, v in attrs }
+                if attrs.get('name') == 'appleConnectForm':
+                    self.url = attrs['action']
+
+        def feed(self, data):
+            try:
+                HTMLParser.HTMLParser.feed(self, data)
+            except HTMLParser.HTMLParseError:
+                pass
+
+    return LoginHTMLParser
+
 def _ensure_parents_exist(filename):
     dirname = os.path.dirname(filename)
     if dirname and not os.path.exists(dirname):
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            # Another download thread may have just created it
+            if e.errno != errno.EEXIST:
+                raise
     assert not dirname or os.path.isdir(dirname), (
             "Path %s is not a directory" % dirname)
 
+def _index_by(items, key):
+    # First match wins, same as a linear scan would
+    index = {}
+    for item in items:
+        index.setdefault(item[key], item)
+    return index
+
 class APIException(Exception): pass
 
 class APIServiceException(APIException):
@@ -58,186 +138,499 @@ class API(object):
 
     GET_TEAM_ID_URL = 'https://developer.apple.com/account/ios/certificate/certificateList.action'
 
-    class _LoginHTMLParser(HTMLParser.HTMLParser):
-        def handle_starttag(self, tag, attrs):
-            if tag == "form":
-                attrs = { k: v for k, v in attrs }
-                if attrs['name'] == 'appleConnectForm':
-                    self.url = attrs['action']
-
-        def feed(self, data):
-            try:
-                HTMLParser.HTMLParser.feed(self, data)
-            except HTMLParser.HTMLParseError:
-                pass
-
-    def __init__(self, debug=False):
-        cookie_jar = cookielib.CookieJar()
-        processor = urllib2.HTTPCookieProcessor(cookie_jar)
-        self._opener = urllib2.build_opener(processor)
-        self._debug = debug
+    def __init__(self, debug=False, session_file=None, cache=None, pool=None,
+            base_url=None, scheduler=None, environment=None):
+        self._cookie_jar = cookielib.CookieJar()
+        processor = urllib2.HTTPCookieProcessor(self._cookie_jar)
+        self._pool = pool or ConnectionPool()
+        self._opener = urllib2.build_opener(processor,
+                *pooled_handlers(self._pool))
+        self.debug = debug
+        self._session_file = session_file
+        # .portalrc section with the credentials, PORTAL_ENVIRONMENT if None
+        self.environment = environment
+        self._session_verified = True
+        self._credentials = None
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+        self._cache_backend = cache
+        self._hooks = []
+        self._scheduler = scheduler or Scheduler()
+        if base_url:
+            # Talk to another host serving the same paths, e.g. fakeportal
+            base_url = base_url.rstrip('/')
+            for name in ('LOGIN_URL', 'DEVELOPER_URL', 'DEVELOPER_SERVICES_URL',
+                         'GET_TEAM_ID_URL'):
+                setattr(self, name, getattr(API, name).replace(
+                        API.DEVELOPER_URL, base_url, 1))
 
     def login(self, user=None, password=None):
         if not user or not password:
             user, password = self._find_credentials()
+        self._credentials = user, password
+        if self._load_session(user):
+            # Validity is only known once the portal answers, see _api
+            self._session_verified = False
+            return
+        self._login(user, password)
+
+    def _login(self, user, password):
+        self._cookie_jar.clear()
         try:
-            r = self._opener.open(self.LOGIN_URL)
-            parser = self._LoginHTMLParser()
+            r = self._open('login', 'login', self.LOGIN_URL)
+            parser = _login_html_parser()()
             page = r.read()
+            r.close()
             parser.feed(page)
             if not parser.url:
-                if self._debug:
+                if self.debug:
                     print >>sys.stderr, "Page contents:\n%s" % page
                 raise APIException("Login failed: unable to locate login URL (HTML scraping failure)")
             scheme, netloc, _, _, _, _ = urlparse.urlparse(r.geturl())
             url = '%s://%s%s' % (scheme, netloc, parser.url)
             params = dict(theAccountName=user, theAccountPW=password,
                           theAuxValue='')
-            r = self._opener.open(url, urllib.urlencode(params))
-            r = self._opener.open(self.GET_TEAM_ID_URL)
+            r = self._open('login', 'authenticate', url,
+                    urllib.urlencode(params))
+            r.read()
+            r.close()
+            r = self._open('login', 'team', self.GET_TEAM_ID_URL)
             page = r.read()
+            r.close()
             matcher = re.search(r'teamId=([A-Z0-9]*)', page)
             if not matcher:
-                if self._debug:
+                if self.debug:
                     print >>sys.stderr, "Login failed, page contents:\n%s" % page
                 raise APIException("Login failed, please check credentials (using %s)" % user)
             self.team_id = matcher.group(1)
             self.user = user
+            self._login_generation += 1
+            self._session_verified = True
+            self._save_session()
         except urllib2.URLError as e:
             raise e
 
+    def close(self):
+        self._pool.close()
+
+    def add_hook(self, hook):
+        # hook(event) is called with a trace.Event for every request and
+        # listing lookup, from the thread that made it
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _emit(self, *args, **kwargs):
+        if self._hooks:
+            event = trace.Event(*args, **kwargs)
+            for hook in list(self._hooks):
+                hook(event)
+
+    def _open(self, kind, endpoint, url, data=None, write=False):
+        # Every request goes through the scheduler, which holds it back
+        # until the portal can take it and retries transient failures
+        request_bytes = len(url) + len(data or '')
+        attempt = 0
+        while True:
+            self._scheduler.acquire(write)
+            start = time.time()
+            try:
+                response = self._opener.open(url, data)
+            except Exception as e:
+                self._scheduler.release(time.time() - start, e)
+                self._emit(kind, endpoint, start, time.time() - start,
+                        request_bytes, error=str(e))
+                delay = self._scheduler.retry_delay(e, write, attempt)
+                if delay is None:
+                    raise
+                if isinstance(e, urllib2.HTTPError) and e.fp is not None:
+                    e.close()
+                if self.debug:
+                    print >>sys.stderr, 'Retrying %s in %.1fs (%s)' % (
+                            endpoint, delay, e)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._scheduler.release(time.time() - start)
+            return trace.MeteredResponse(response, lambda r: self._emit(kind,
+                    endpoint, start, time.time() - start, request_bytes,
+                    r.size, r.result_code))
+
+    def _relogin(self, generation):
+        with self._login_lock:
+            # Another thread may have logged in again in the meantime
+            if generation != self._login_generation:
+                return
+            if self.debug:
+                print >>sys.stderr, "Session expired, logging in again"
+            self._login(*self._credentials)
+
+    def _load_session(self, user):
+        if not self._session_file:
+            return False
+        try:
+            with open(self._session_file) as f:
+                session = json.load(f)
+            if session['user'] != user:
+                return False
+            cookies = [ cookielib.Cookie(**c) for c in session['cookies'] ]
+            team_id = session['team_id']
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        cookies = [ c for c in cookies if not c.is_expired() ]
+        if not cookies:
+            return False
+        self._cookie_jar.clear()
+        for cookie in cookies:
+            self._cookie_jar.set_cookie(cookie)
+        self.team_id = team_id
+        self.user = user
+        return True
+
+    def _save_session(self):
+        if not self._session_file:
+            return
+        cookies = []
+        for cookie in self._cookie_jar:
+            c = dict((k, getattr(cookie, k)) for k in self._COOKIE_ATTRS)
+            c['rest'] = cookie._rest
+            cookies.append(c)
+        session = dict(user=self.user, team_id=self.team_id, cookies=cookies)
+        _ensure_parents_exist(self._session_file)
+        tmp = '%s.%d.tmp' % (self._session_file, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session, f)
+        os.rename(tmp, self._session_file)
+
+    def _is_session_expired(self, data):
+        # Expired sessions get the HTML login page instead of JSON, however
+        # long they worked before (portal serve keeps them for hours)
+        if data is None:
+            return True
+        return data.get('resultCode') == self.SESSION_EXPIRED_RESULT_CODE
+
     def _api(self, cmd, form={}, **kwargs):
         try:
             if isinstance(form, (dict, list)):
                 form = urllib.urlencode(form)
-            kwargs['content-type'] = 'text/x-url-arguments'
-            kwargs['accept'] = 'application/json'
-            kwargs['requestId'] = str(uuid.uuid4())
-            kwargs['userLocale'] = 'en_US'
-            kwargs['teamId'] = self.team_id
-            query = urllib.urlencode(kwargs)
-            url = "%s/%s?%s" % (self.DEVELOPER_SERVICES_URL, cmd, query)
-            response = self._opener.open(url, form)
-            assert response.getcode() == 200, "Error %" % response.getcode()
-            data = json.loads(response.read())
-            rc = data['resultCode']
-            if rc not in [ 0, 8500 ]:
-                raise APIServiceException(data)
+            generation = self._login_generation
+            data = self._api_request(cmd, form, kwargs)
+            if self._is_session_expired(data) and self._credentials:
+                self._relogin(generation)
+                data = self._api_request(cmd, form, kwargs)
+            if data is None:
+                raise APIException("Unexpected response for '%s'" % cmd)
+            self._session_verified = True
+            self._check_result(data)
             return data
         except urllib2.URLError as e:
             raise e
 
-    def _find_credentials(self):
-        # First try environment variables
+    def _api_iter(self, cmd, key, form={}, fields=None, **kwargs):
+        # Like _api, but yields the items of the `key` array as they are
+        # decoded instead of loading the whole response at once. The other
+        # top level members end up in `fields` if given.
+        if isinstance(form, (dict, list)):
+            form = urllib.urlencode(form)
+        generation = self._login_generation
+        for attempt in (0, 1):
+            data = {}
+            response = self._api_open(cmd, form, kwargs)
+            items = jsonstream.iter_array(response, key, data)
+            try:
+                first = next(items, None)
+            except ValueError:
+                response.close()
+                first, data = None, None
+            if (attempt == 0 and first is None and self._credentials and
+                    self._is_session_expired(data)):
+                response.result_code = data and data.get('resultCode')
+                response.close()
+                self._relogin(generation)
+                continue
+            break
         try:
-            credentials = os.environ['PORTAL_CREDENTIALS']
-            user, password = credentials.split(':')
-            return user, password
-        except (KeyError, ValueError):
-            pass
+            if data is None:
+                raise APIException("Unexpected response for '%s'" % cmd)
+            self._session_verified = True
+            if first is not None:
+                # resultCode usually precedes the items
+                if 'resultCode' in data:
+                    self._check_result(data)
+                yield first
+                for item in items:
+                    yield item
+            if 'resultCode' not in data:
+                raise APIException("Unexpected response for '%s'" % cmd)
+            self._check_result(data)
+            response.read()
+            if fields is not None:
+                fields.update(data)
+        finally:
+            if data:
+                response.result_code = data.get('resultCode')
+            response.close()
+
+    def _check_result(self, data):
+        rc = data['resultCode']
+        if rc not in [ 0, 8500 ]:
+            raise APIServiceException(data)
+
+    def _api_request(self, cmd, form, kwargs):
+        response = self._api_open(cmd, form, kwargs)
+        try:
+            page = response.read()
+            data = json.loads(page)
+            if isinstance(data, dict):
+                response.result_code = data.get('resultCode')
+            return data
+        except ValueError:
+            # Expired sessions get redirected to the HTML login page
+            if self.debug:
+                print >>sys.stderr, "Page contents:\n%s" % page
+            return None
+        finally:
+            response.close()
+
+    def _api_open(self, cmd, form, kwargs):
+        kwargs = dict(kwargs)
+        kwargs['content-type'] = 'text/x-url-arguments'
+        kwargs['accept'] = 'application/json'
+        kwargs['requestId'] = str(_uuid4())
+        kwargs['userLocale'] = 'en_US'
+        kwargs['teamId'] = self.team_id
+        query = urllib.urlencode(kwargs)
+        url = "%s/%s?%s" % (self.DEVELOPER_SERVICES_URL, cmd, query)
+        write = not cmd.split('/')[-1].startswith(self._READ_COMMANDS)
+        response = self._open('api', cmd, url, form, write)
+        assert response.getcode() == 200, "Error %" % response.getcode()
+        return response
 
-        # Now try .portalrc file
-        def search_path():
-            yield os.path.expanduser('~/.portalrc')
-            path = os.getcwd()
-            while True:
-                filename = os.path.join(path, '.portalrc')
-                if os.path.isfile(filename):
-                    yield filename
-                    break
-                if path == '/':
-                    break
-                path = os.path.dirname(path)
+    def _find_credentials(self):
+        # First try environment variables, unless given a .portalrc section
+        if self.environment is None:
+            try:
+                credentials = os.environ['PORTAL_CREDENTIALS']
+                user, password = credentials.split(':')
+                return user, password
+            except (KeyError, ValueError):
+                pass
 
+        # Now try .portalrc file
         import ConfigParser
-        group = os.environ.get('PORTAL_ENVIRONMENT', 'Default')
+        group = self.environment or os.environ.get('PORTAL_ENVIRONMENT',
+                                                   'Default')
         try:
-            cfg = ConfigParser.RawConfigParser()
-            cfg.read(search_path())
+            cfg = _portalrc()
             return cfg.get(group, 'user'), cfg.get(group, 'password')
         except ConfigParser.Error:
             raise APIException('Missing credentials '
                 '(.portalrc section [%s] / PORTAL_CREDENTIALS)' % group)
 
     def _list_cert_requests(self):
-        data = self._api("certificate/listCertRequests", certificateStatus=0,
-            types=self.ALL_CERT_TYPES)
-        return data['certRequests']
+        return [ records.CertRequest(c) for c in self._api_iter(
+                 "certificate/listCertRequests", 'certRequests',
+                 certificateStatus=0, types=self.ALL_CERT_TYPES) ]
 
     def _list_app_ids(self):
-        data = self._api('identifiers/listAppIds') #, onlyCountLists='true')
-        return data['appIds']
+        return [ records.AppId(a) for a in self._api_iter(
+                 'identifiers/listAppIds', 'appIds') ] #, onlyCountLists='true')
 
     def _list_provisioning_profiles(self):
-        data = self._api('profile/listProvisioningProfiles',
-                includeInactiveProfiles='true', onlyCountLists='true')
-        return data['provisioningProfiles']
+        return [ self._attach_loader(records.Profile(p)) for p in self._api_iter(
+                 'profile/listProvisioningProfiles', 'provisioningProfiles',
+                 includeInactiveProfiles='true', onlyCountLists='true') ]
 
     def _list_devices(self, include_removed=True):
-        data = self._api('device/listDevices',
-                includeRemovedDevices='true' if include_removed else 'false')
-        return data['devices']
-
-    def clear_cache(self):
-        for n in self.__dict__:
+        return [ records.Device(d) for d in self._api_iter(
+                 'device/listDevices', 'devices',
+                 includeRemovedDevices='true' if include_removed else 'false') ]
+
+    def _iter_pages(self, cmd, key, record_class, page_size, **kwargs):
+        page_size = page_size or self.LISTING_PAGE_SIZE
+        page = seen = 0
+        while True:
+            page += 1
+            fields = {}
+            count = 0
+            for item in self._api_iter(cmd, key, fields=fields,
+                    pageNumber=page, pageSize=page_size, **kwargs):
+                count += 1
+                yield record_class(item)
+            seen += count
+            total = fields.get('totalRecords')
+            # Stop as well when the endpoint ignored the paging parameters
+            if count < page_size or (seen >= total if total is not None
+                                     else fields.get('pageNumber') != page):
+                return
+
+    def _iter_listing(self, name, record_class, predicate, fetch_pages):
+        # Serve from whatever cache already holds the listing, otherwise
+        # page through it on the server
+        start = time.time()
+        items = getattr(self, 'all_%s_cache' % name, None)
+        if items is None and self._cache_backend is not None:
+            items = self._cache_backend.get(self.team_id, name)
+        self._emit('cache', name, start, time.time() - start,
+                cached=items is not None)
+        if items is None:
+            items = fetch_pages()
+        for item in items:
+            if not isinstance(item, record_class):
+                item = record_class(item)
+            if predicate is None or predicate(item):
+                yield item
+
+    def iter_cert_requests(self, predicate=None, page_size=None):
+        return self._iter_listing('cert_requests', records.CertRequest, predicate,
+                lambda: self._iter_pages("certificate/listCertRequests",
+                    'certRequests', records.CertRequest, page_size,
+                    certificateStatus=0, types=self.ALL_CERT_TYPES))
+
+    def iter_app_ids(self, predicate=None, page_size=None):
+        return self._iter_listing('app_ids', records.AppId, predicate,
+                lambda: self._iter_pages('identifiers/listAppIds', 'appIds',
+                    records.AppId, page_size))
+
+    def iter_provisioning_profiles(self, predicate=None, page_size=None):
+        profiles = self._iter_listing('provisioning_profiles', records.Profile,
+                predicate, lambda: self._iter_pages(
+                    'profile/listProvisioningProfiles', 'provisioningProfiles',
+                    records.Profile, page_size,
+                    includeInactiveProfiles='true', onlyCountLists='true'))
+        return (self._attach_loader(p) for p in profiles)
+
+    def iter_devices(self, predicate=None, page_size=None):
+        return self._iter_listing('devices', records.Device, predicate,
+                lambda: self._iter_pages('device/listDevices', 'devices',
+                    records.Device, page_size, includeRemovedDevices='true'))
+
+    def clear_cache(self, disk=True):
+        for n in list(self.__dict__):
             if n.endswith('_cache'):
                 delattr(self, n)
+        if disk and self._cache_backend is not None:
+            self._cache_backend.clear(self.team_id)
+
+    def refresh_listings(self):
+        # Fetch every listing from the portal without reading the caches,
+        # then store the results in them for everybody else
+        for name, fetch in (('cert_requests', self._list_cert_requests),
+                            ('app_ids', self._list_app_ids),
+                            ('provisioning_profiles',
+                             self._list_provisioning_profiles),
+                            ('devices', self._list_devices)):
+            items = fetch()
+            if self._cache_backend is not None:
+                self._cache_backend.put(self.team_id, name, items)
+            for method in self._LISTING_CACHES[name]:
+                self.__dict__.pop('%s_cache' % method, None)
+            setattr(self, 'all_%s_cache' % name, items)
+
+    def _cached_listing(self, name, fetch, record_class):
+        if self._cache_backend is None:
+            return fetch()
+        start = time.time()
+        fetched = []
+        def fetch_once():
+            fetched.append(True)
+            return fetch()
+        items = self._cache_backend.get_or_fetch(self.team_id, name, fetch_once)
+        self._emit('cache', name, start, time.time() - start,
+                cached=not fetched)
+        return records.wrap(record_class, items)
+
+    # In-memory caches built from each listing
+    _LISTING_CACHES = dict(
+        cert_requests=('all_cert_requests', '_cert_requests_by_type'),
+        app_ids=('all_app_ids', '_app_ids_by_identifier', '_app_ids_by_id'),
+        devices=('all_devices', '_devices_by_number', '_devices_by_id'),
+        provisioning_profiles=('all_provisioning_profiles',
+                '_provisioning_profiles_by_id',
+                '_provisioning_profiles_by_app_and_type'))
+
+    def _invalidate_listing(self, name):
+        for method in self._LISTING_CACHES[name]:
+            self.__dict__.pop('%s_cache' % method, None)
+        if self._cache_backend is not None:
+            self._cache_backend.invalidate(self.team_id, name)
 
     @cached_method
     def all_cert_requests(self):
-        return self._list_cert_requests()
+        return self._cached_listing('cert_requests', self._list_cert_requests,
+                records.CertRequest)
 
     def list_cert_requests(self, typ):
         if not isinstance(typ, list):
             typ = [ typ ]
-        return [ c for c in self.all_cert_requests()
-                 if c['certificateTypeDisplayId'] in typ ]
+        index = self._cert_requests_by_type()
+        certs = self.all_cert_requests()
+        # Keep listing order when several types are requested
+        return [ certs[ix] for ix in sorted(ix for t in set(typ)
+                                            for ix in index.get(t, ())) ]
+
+    @cached_method
+    def _cert_requests_by_type(self):
+        index = {}
+        for ix, cert in enumerate(self.all_cert_requests()):
+            index.setdefault(cert['certificateTypeDisplayId'], []).append(ix)
+        return index
 
     @cached_method
     def all_app_ids(self):
-        return self._list_app_ids()
+        return self._cached_listing('app_ids', self._list_app_ids,
+                records.AppId)
 
     def get_app_id(self, app_id):
         if isinstance(app_id, (list, tuple)):
             return [ self.get_app_id(a) for a in app_id ]
-        if isinstance(app_id, dict):
+        if isinstance(app_id, Mapping):
             return app_id
         if not isinstance(app_id, basestring):
             raise APIException('invalid app_id %s' % app_id)
-        try:
-            if '.' in app_id:
-                return next(a for a in self.all_app_ids()
-                            if a['identifier'] == app_id)
-            else:
-                return next(a for a in self.all_app_ids()
-                            if a['appIdId'] == app_id)
-        except StopIteration:
-            return None
+        # Identifiers are bundle ids, wildcards included ('*')
+        if '.' in app_id or app_id == '*':
+            return self._app_ids_by_identifier().get(app_id)
+        else:
+            return self._app_ids_by_id().get(app_id)
+
+    @cached_method
+    def _app_ids_by_identifier(self):
+        return _index_by(self.all_app_ids(), 'identifier')
+
+    @cached_method
+    def _app_ids_by_id(self):
+        return _index_by(self.all_app_ids(), 'appIdId')
 
     @cached_method
     def all_devices(self):
-        return self._list_devices()
+        return self._cached_listing('devices', self._list_devices,
+                records.Device)
 
     def get_device(self, device, return_id_if_missing=False):
         if isinstance(device, (list, tuple)):
             return [ self.get_device(d,
                      return_id_if_missing=return_id_if_missing)
                      for d in device ]
-        if isinstance(device, dict):
+        if isinstance(device, Mapping):
             return device
         if not isinstance(device, basestring):
             raise APIException('invalid device %s' % device)
-        try:
-            if re.match('[0-9a-f]{40}', device, re.I):
-                return next(d for d in self.all_devices()
-                            if d['deviceNumber'] == device)
-            else:
-                return next(d for d in self.all_devices()
-                            if d['deviceId'] == device)
-        except StopIteration:
-            if return_id_if_missing:
-                return device
-            return None
+        if re.match('[0-9a-f]{40}', device, re.I):
+            index = self._devices_by_number()
+        else:
+            index = self._devices_by_id()
+        return index.get(device, device if return_id_if_missing else None)
+
+    @cached_method
+    def _devices_by_number(self):
+        return _index_by(self.all_devices(), 'deviceNumber')
+
+    @cached_method
+    def _devices_by_id(self):
+        return _index_by(self.all_devices(), 'deviceId')
 
     def add_device(self, udid, name=None):
         name = name or udid
@@ -248,51 +641,147 @@ class API(object):
         form.append(('deviceNames', name))
         form.append(('deviceNumbers', udid))
         data = self._api("device/addDevice", form=form)
-        return data['device']
+        self._invalidate_listing('devices')
+        return records.Device(data['device'])
+
+    def unregistered_devices(self, devices):
+        registered = set(d['deviceNumber'].lower() for d in self.all_devices())
+        pending = []
+        for device in devices:
+            udid, name = (device, device) if isinstance(device, basestring) \
+                         else device
+            if udid.lower() not in registered:
+                registered.add(udid.lower())
+                pending.append((udid, name or udid))
+        return pending
+
+    def add_devices(self, devices, batch_size=None):
+        batch_size = batch_size or self.ADD_DEVICES_BATCH_SIZE
+        pending = self.unregistered_devices(devices)
+        added = []
+        try:
+            for ix in xrange(0, len(pending), batch_size):
+                form = []
+                form.append(('register', 'multiple'))
+                for udid, name in pending[ix:ix + batch_size]:
+                    form.append(('deviceNames', name))
+                    form.append(('deviceNumbers', udid))
+                data = self._api("device/addDevices", form=form)
+                added.extend(records.Device(d) for d in data['devices'])
+        finally:
+            if added:
+                self._invalidate_listing('devices')
+        return added
 
     def delete_device(self, device):
-        if not isinstance(device, (basestring, dict)):
+        if not isinstance(device, (basestring, Mapping)):
             raise APIException('invalid device %s' % device)
         device = self.get_device(device)
         self._api('device/deleteDevice',
                 deviceId=device['deviceId'])
+        self._invalidate_listing('devices')
 
     def enable_device(self, device):
-        if not isinstance(device, (basestring, dict)):
+        if not isinstance(device, (basestring, Mapping)):
             raise APIException('invalid device %s' % device)
         device = self.get_device(device)
         data = self._api('device/enableDevice',
                 displayId=device['deviceId'],
                 deviceNumber=device['deviceNumber'])
-        return data['device']
+        self._invalidate_listing('devices')
+        return records.Device(data['device'])
 
     @cached_method
     def all_provisioning_profiles(self):
-        return self._list_provisioning_profiles()
+        profiles = self._cached_listing('provisioning_profiles',
+                self._list_provisioning_profiles, records.Profile)
+        for profile in profiles:
+            self._attach_loader(profile)
+        return profiles
+
+    def _attach_loader(self, profile):
+        # Device and certificate ids get fetched when first needed
+        profile.set_loader(self.get_provisioning_profile_details)
+        return profile
+
+    def prefetch_profile_details(self, profiles, jobs=8):
+        # Load the details of all profiles lacking them, concurrently
+        profiles = self.get_provisioning_profile(list(profiles))
+        pending = [ p for p in profiles if isinstance(p, Mapping) and
+                    not (p.has_details if isinstance(p, records.Profile)
+                         else 'deviceIds' in p) ]
+        details = self.get_provisioning_profile_details(pending, jobs=jobs)
+        for profile, detail in zip(pending, details):
+            if isinstance(profile, records.Profile):
+                profile.update_details(detail)
+            else:
+                profile.update(detail)
+        return profiles
 
     def get_provisioning_profile(self, profile, return_id_if_missing=False):
         if isinstance(profile, (list, tuple)):
             return [ self.get_provisioning_profile(p,
                          return_id_if_missing=return_id_if_missing)
                      for p in profile ]
-        if isinstance(profile, dict):
+        if isinstance(profile, Mapping):
             return profile
         if not isinstance(profile, basestring):
             raise APIException('invalid profile id %s' % profile)
-        try:
-            return next(p for p in self.all_provisioning_profiles()
-                        if p['provisioningProfileId'] == profile)
-        except StopIteration:
-            if return_id_if_missing:
-                return profile
-            return None
+        return self._provisioning_profiles_by_id().get(profile,
+                profile if return_id_if_missing else None)
+
+    def get_provisioning_profile_details(self, profile, jobs=1):
+        # The listings only count devices and certificates, the details hold
+        # their ids. Lists of profiles are fetched jobs at a time.
+        if isinstance(profile, (list, tuple)):
+            ids = self._unwrap(profile, 'provisioningProfileId')
+            results = dict((r.item, r.result) for r in self.bulk(
+                    self.get_provisioning_profile_details, set(ids),
+                    jobs=jobs, fail_fast=True))
+            return [ results[i] for i in ids ]
+        profile = self._unwrap(profile, 'provisioningProfileId')
+        data = self._api('profile/getProvisioningProfile',
+                provisioningProfileId=profile)
+        return records.Profile(data['provisioningProfile'])
+
+    def plan(self, manifest, jobs=1):
+        # The changes (sync.Change) bringing the profiles in line with
+        # manifest, see portal.sync
+        return sync.plan(self, manifest, jobs=jobs)
+
+    def apply(self, changes, jobs=1, callback=None, fail_fast=False):
+        changes = [ c for c in changes if c.action != sync.KEEP ]
+        return self.bulk(self.apply_change, changes, jobs=jobs,
+                callback=callback, fail_fast=fail_fast)
+
+    def apply_change(self, change):
+        return sync.apply_change(self, change)
+
+    def find_provisioning_profiles(self, app_id, profile_type):
+        if isinstance(app_id, Mapping):
+            app_id = app_id['identifier']
+        key = app_id, self.profile_type(profile_type)
+        return list(self._provisioning_profiles_by_app_and_type().get(key, ()))
+
+    @cached_method
+    def _provisioning_profiles_by_id(self):
+        return _index_by(self.all_provisioning_profiles(),
+                'provisioningProfileId')
+
+    @cached_method
+    def _provisioning_profiles_by_app_and_type(self):
+        index = {}
+        for profile in self.all_provisioning_profiles():
+            key = profile['appId']['identifier'], self.profile_type(profile)
+            index.setdefault(key, []).append(profile)
+        return index
 
     def create_provisioning_profile(self, profile_type, app_id, certificates=None,
             devices=None, name=None):
         if not 0 <= profile_type < 3:
             raise APIException('profile_type must be one of ' +
               ', '.join(t for t in dir(API) if t.startswith('PROFILE_TYPE_')))
-        if not isinstance(app_id, (dict, basestring)):
+        if not isinstance(app_id, (Mapping, basestring)):
             raise APIException('invalid app_id %s' % app_id)
         distribution_type = 'limited adhoc store'.split()[profile_type]
         if profile_type == self.PROFILE_TYPE_DEVELOPMENT:
@@ -330,12 +819,14 @@ class API(object):
         form.append(('certificateCount', len(certificates)))
         form.append(('deviceCount', len(devices) if devices else ''))
         data = self._api("profile/createProvisioningProfile", form=form)
-        return data['provisioningProfile']
+        self._invalidate_listing('provisioning_profiles')
+        return self._attach_loader(records.Profile(data['provisioningProfile']))
 
     def delete_provisioning_profile(self, profile):
         profile = self._unwrap(profile, 'provisioningProfileId')
         self._api('profile/deleteProvisioningProfile',
             provisioningProfileId=profile)
+        self._invalidate_listing('provisioning_profiles')
 
     def _format_list(self, objs):
         if objs:
@@ -359,42 +850,117 @@ class API(object):
         form.append(('returnFullObjects', 'false'))
         form.append(('provisioningProfileName', name or profile['name']))
         form.append(('appIdId', app_id or profile['appId']['appIdId']))
-        for certificate_id in certificate_ids or profile['certificateIds']:
-            if isinstance(certificate_id, dict):
+        if certificate_ids is None:
+            certificate_ids = profile['certificateIds']
+        for certificate_id in certificate_ids:
+            if isinstance(certificate_id, Mapping):
                 certificate_id = certificate_id['certificateId']
             form.append(('certificateIds', certificate_id))
         if device_ids is None:
             device_ids = profile['deviceIds']
         for device_id in device_ids:
-            if isinstance(device_id, dict):
+            if isinstance(device_id, Mapping):
                 device_id = device_id['deviceId']
             form.append(('deviceIds', device_id))
-        return self._api('profile/regenProvisioningProfile', form=form)
+        data = self._api('profile/regenProvisioningProfile', form=form)
+        self._invalidate_listing('provisioning_profiles')
+        return data
 
     def _make_dev_url(self, path, **kwargs):
         query = urllib.urlencode(kwargs)
         return "%s/%s.action?%s" % (self.DEVELOPER_URL, path, query)
 
-    def download_profile(self, profile, file_or_filename):
+    def download_profile(self, profile, file_or_filename, expected_size=None,
+            expected_sha1=None):
         try:
-            if isinstance(profile, dict):
+            if isinstance(profile, Mapping):
                 profile = profile['provisioningProfileId']
             url = self._make_dev_url('account/ios/profile/profileContentDownload',
                     displayId=profile)
-            r = self._opener.open(url)
-            assert r.getcode() == 200, 'Unable to download profile [%s]' % profile
-            profile = r.read()
-            if isinstance(file_or_filename, basestring):
+            generation = self._login_generation
+            r = self._open('download', 'profileContentDownload', url)
+            # Profiles never come as HTML, that is the login page of an
+            # expired session
+            if 'text/html' in r.info().get('content-type', ''):
+                r.close()
+                if not self._credentials:
+                    raise APIException('Session expired downloading '
+                                       "profile '%s'" % profile)
+                self._relogin(generation)
+                r = self._open('download', 'profileContentDownload', url)
+                if 'text/html' in r.info().get('content-type', ''):
+                    r.close()
+                    raise APIException("Unable to download profile '%s': "
+                                       'got the login page' % profile)
+            try:
+                assert r.getcode() == 200, 'Unable to download profile [%s]' % profile
+                self._session_verified = True
+                if not isinstance(file_or_filename, basestring):
+                    self._copy_profile(profile, r, file_or_filename,
+                            expected_size, expected_sha1)
+                    return
+                # Write next to the destination and rename over it, so readers
+                # never see a partially written profile
                 _ensure_parents_exist(file_or_filename)
-                with open(file_or_filename, 'wb') as f:
-                    f.write(profile)
-            else:
-                file_or_filename.write(profile)
+                tmp = '%s.%s.tmp' % (file_or_filename, _uuid4().hex)
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        self._copy_profile(profile, r, f,
+                                expected_size, expected_sha1)
+                    if os.name == 'nt' and os.path.exists(file_or_filename):
+                        os.remove(file_or_filename)
+                    os.rename(tmp, file_or_filename)
+                except:
+                    os.remove(tmp)
+                    raise
+            finally:
+                r.close()
         except urllib2.HTTPError as e:
             if e.getcode() == 404:
                 raise APIException("Profile '%s' not found" % profile)
             raise e
 
+    def _copy_profile(self, profile, r, f, expected_size, expected_sha1):
+        size = 0
+        sha1 = hashlib.sha1()
+        while True:
+            chunk = r.read(self.DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            sha1.update(chunk)
+            size += len(chunk)
+        content_length = r.info().get('content-length')
+        if content_length and int(content_length) != size:
+            raise APIException("Truncated download for profile '%s' "
+                "(got %d of %s bytes)" % (profile, size, content_length))
+        if expected_size is not None and expected_size != size:
+            raise APIException("Unexpected size for profile '%s' "
+                "(got %d bytes, expected %d)" % (profile, size, expected_size))
+        if expected_sha1 is not None and expected_sha1 != sha1.hexdigest():
+            raise APIException("Checksum mismatch for profile '%s'" % profile)
+
+    def bulk(self, fn, items, jobs=1, callback=None, fail_fast=False):
+        items = list(items)
+        results = []
+        if items and not self._session_verified:
+            # Settle a restored session before fanning out
+            results = bulk_execute(fn, items[:1], callback=callback,
+                    fail_fast=fail_fast)
+            items = items[1:]
+        return results + bulk_execute(fn, items, jobs=jobs,
+                callback=callback, fail_fast=fail_fast)
+
+    def download_profiles(self, downloads, jobs=1, callback=None):
+        def download(item):
+            self.download_profile(*item)
+        def downloaded(result):
+            if callback:
+                callback(*result.item)
+        self.bulk(download, downloads, jobs=jobs, callback=downloaded,
+                fail_fast=True)
+
     def profile_type(self, profile):
         if isinstance(profile, int):
             if not 0 <= profile < len(API._PROFILE_TYPE_LABELS):
@@ -409,13 +975,11 @@ class API(object):
                 return API._PROFILE_TYPE_LABELS.index(profile)
             except ValueError:
                 raise APIException("Invalid profile type '%s'" % profile)
-        if not isinstance(profile, dict):
+        if isinstance(profile, records.Profile):
+            return profile.profile_type
+        if not isinstance(profile, Mapping):
             raise APIException('Invalid  profile %s' % profile)
-        if profile['type'] == 'Development':
-            return API.PROFILE_TYPE_DEVELOPMENT
-        if profile['deviceCount']:
-            return API.PROFILE_TYPE_ADHOC
-        return API.PROFILE_TYPE_APPSTORE
+        return records.profile_type(profile)
 
     def profile_type_name(self, profile):
         return API._PROFILE_TYPE_LABELS[self.profile_type(profile)]
@@ -423,9 +987,18 @@ class API(object):
     def is_profile_expired(self, profile):
         return profile['status'] == 'Expired'
 
-    PROFILE_TYPE_DEVELOPMENT = 0
-    PROFILE_TYPE_ADHOC = 1
-    PROFILE_TYPE_APPSTORE = 2
+    SESSION_EXPIRED_RESULT_CODE = 1100
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    ADD_DEVICES_BATCH_SIZE = 100
+    LISTING_PAGE_SIZE = 500
+    _READ_COMMANDS = ('list', 'get', 'view')
+    _COOKIE_ATTRS = ('version name value port port_specified domain ' +
+            'domain_specified domain_initial_dot path path_specified ' +
+            'secure expires discard comment comment_url rfc2109').split()
+
+    PROFILE_TYPE_DEVELOPMENT = records.PROFILE_TYPE_DEVELOPMENT
+    PROFILE_TYPE_ADHOC = records.PROFILE_TYPE_ADHOC
+    PROFILE_TYPE_APPSTORE = records.PROFILE_TYPE_APPSTORE
     _PROFILE_TYPE_LABELS = 'development adhoc appstore'.split()
 
     ALL_CERT_TYPES = "5QPB9NHCEI,R58UK2EWSO,9RQEK7MSXA,LA30L5BJEU,BKLRAVXMGM,3BQKVH9I2X,Y3B2F3TYSI"
@@ -0,0 +1,63 @@
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from .api import API
+from .cache import LISTINGS
+
+def gather(futures):
+    return [ f.get() for f in futures ]
+
+class AsyncAPI(object):
+    # Same surface as API, but every public method returns an AsyncResult
+    # right away and runs on a shared pool of threads. Requests still block
+    # their thread, so jobs bounds the calls in flight. Parsing, caching,
+    # sessions and errors are those of the wrapped API, whose connection
+    # pool is thread safe. Other attributes go to the API as is.
+
+    # Local helpers, called directly
+    LOCAL = frozenset(('add_hook remove_hook clear_cache profile_type ' +
+            'profile_type_name is_profile_expired').split())
+
+    def __init__(self, api=None, jobs=8, **kwargs):
+        self.api = api or API(**kwargs)
+        self._pool = ThreadPool(jobs)
+
+    def _submit(self, fn, *args, **kwargs):
+        return self._pool.apply_async(fn, args, kwargs)
+
+    def __getattr__(self, name):
+        if name == 'api':
+            raise AttributeError(name)
+        value = getattr(self.api, name)
+        if name.startswith('_') or name in self.LOCAL or not callable(value):
+            return value
+        if name.startswith('iter_'):
+            # Generators would only run once iterated, in the caller
+            raise AttributeError("AsyncAPI has no %s, use all_%s" % (name,
+                                 name[len('iter_'):]))
+        @wraps(value)
+        def method(*args, **kwargs):
+            return self._submit(value, *args, **kwargs)
+        return method
+
+    def all_listings(self):
+        # Fetch every listing concurrently, resolving to {listing: items}
+        futures = dict((name, getattr(self, 'all_%s' % name)())
+                       for name in LISTINGS)
+        return self._submit(lambda: dict((name, f.get())
+                                         for name, f in futures.items()))
+
+    def map(self, name, items, *args, **kwargs):
+        fn = getattr(self.api, name)
+        return [ self._submit(fn, item, *args, **kwargs) for item in items ]
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.api.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
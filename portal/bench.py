@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# Benchmarks for the API and CLI hot paths, run against an in-process
+# fakeportal so they need no network or account:
+#
+#   python -m portal.bench run -o before.json
+#   python -m portal.bench run -o after.json
+#   python -m portal.bench compare -t 0.1 before.json after.json
+from contextlib import contextmanager
+from StringIO import StringIO
+
+import gc
+import getopt
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import portal
+import portal.cli
+from portal.fakeportal import FakePortal
+
+USAGE = '''Usage: python -m portal.bench run [-s scale] [-r repeat] [-k regex] [-o output]
+       python -m portal.bench compare [-t threshold] BASELINE RESULTS
+
+run      Runs the benchmarks and writes their results as JSON (to stdout
+         unless -o is given). -s sets the number of devices (profiles are
+         a fifth of that), -r how many times each benchmark runs (the best
+         run counts) and -k only runs the benchmarks matching regex.
+         Exits with 1 when the CLI startup is over budget.
+compare  Compares two result files, exiting with 1 when a metric got worse
+         by more than the threshold (a fraction, defaults to 0.1)
+'''
+
+BENCHMARKS = []
+
+# How much longer than a bare interpreter the CLI may take to print its
+# usage, and modules it must not load until a command talks to the portal
+STARTUP_BUDGET = 0.05
+STARTUP_UNWANTED = ('urllib2', 'cookielib', 'socket', 'ssl', 'uuid',
+                    'multiprocessing', 'portal.api')
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+class Context(object):
+    def __init__(self, scale, repeat):
+        self.scale = scale
+        self.repeat = repeat
+        self.metrics = {}
+        self.failures = []
+
+    def portal(self, **kwargs):
+        kwargs.setdefault('devices', self.scale)
+        kwargs.setdefault('profiles', max(1, self.scale / 5))
+        kwargs.setdefault('apps', max(2, self.scale / 50))
+        return FakePortal(**kwargs)
+
+    def api(self, fake, **kwargs):
+        api = fake.install(portal.API(base_url='http://fakeportal.invalid',
+                                      **kwargs))
+        api.login(fake.user, fake.password)
+        return api
+
+    def record(self, name, value, unit='s'):
+        self.metrics[name] = dict(value=value, unit=unit)
+
+    def check(self, ok, message):
+        if not ok:
+            self.failures.append(message)
+
+    def time(self, name, fn, setup=None, number=1):
+        # Best of `repeat` runs, setup (whose result is passed to fn) is
+        # not timed
+        best = None
+        for _ in xrange(self.repeat):
+            arg = setup() if setup else None
+            gc.collect()
+            start = time.time()
+            for _ in xrange(number):
+                fn(arg) if setup else fn()
+            elapsed = (time.time() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+        self.record(name, best)
+        return best
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return None
+
+@contextmanager
+def _quiet():
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+def _run_cli(fake, *args):
+    make_api = portal.cli._make_api
+    portal.cli._make_api = lambda cache=None: fake.install(
+            portal.API(base_url='http://fakeportal.invalid'))
+    credentials = os.environ.get('PORTAL_CREDENTIALS')
+    os.environ['PORTAL_CREDENTIALS'] = '%s:%s' % (fake.user, fake.password)
+    argv = sys.argv
+    sys.argv = [ 'portal' ] + list(args)
+    portal.cli.opts.clear()
+    try:
+        with _quiet():
+            return portal.cli.main()
+    finally:
+        sys.argv = argv
+        portal.cli._make_api = make_api
+        if credentials is None:
+            del os.environ['PORTAL_CREDENTIALS']
+        else:
+            os.environ['PORTAL_CREDENTIALS'] = credentials
+
+@benchmark
+def api_request(ctx):
+    fake = ctx.portal(devices=1, profiles=1, apps=1)
+    api = ctx.api(fake)
+    ctx.time('api_request', lambda: api._api('identifiers/listAppIds'),
+             number=200)
+
+@benchmark
+def listing_parse(ctx):
+    fake = ctx.portal()
+    api = ctx.api(fake)
+    ctx.time('list_devices', api._list_devices)
+    ctx.time('list_provisioning_profiles', api._list_provisioning_profiles)
+    gc.collect()
+    before = _rss()
+    devices = api._list_devices()
+    profiles = api._list_provisioning_profiles()
+    gc.collect()
+    after = _rss()
+    if before is not None:
+        ctx.record('listing_memory', after - before, 'bytes')
+    del devices, profiles
+
+@benchmark
+def lookups(ctx):
+    fake = ctx.portal()
+    api = ctx.api(fake)
+    device_ids = [ d['deviceId'] for d in api.all_devices() ]
+    profile_ids = [ p['provisioningProfileId']
+                    for p in api.all_provisioning_profiles() ]
+    ctx.time('get_device', lambda: [ api.get_device(d) for d in device_ids ])
+    ctx.time('get_provisioning_profile', lambda: [
+             api.get_provisioning_profile(p) for p in profile_ids ])
+
+@benchmark
+def filters(ctx):
+    fake = ctx.portal()
+    portal.cli.api = api = ctx.api(fake)
+    api.all_devices()
+    api.all_provisioning_profiles()
+    def run(fn, **opts):
+        portal.cli.opts.clear()
+        portal.cli.opts.update(opts)
+        fn([])
+    ctx.time('filter_devices', lambda: run(portal.cli._filter_devices,
+             m='device 1', u='^[0-9a]'))
+    ctx.time('filter_profiles', lambda: run(portal.cli._filter_profiles,
+             m='app', t='adhoc'))
+    portal.cli.opts.clear()
+
+@benchmark
+def regenerate_all(ctx):
+    def setup():
+        fake = ctx.portal()
+        # New devices make every development and ad hoc profile outdated
+        for i in xrange(10):
+            fake.devices.append(fake._make_device(ctx.scale + i))
+        return fake
+    ctx.time('cli_regenerate_profile_all', lambda fake: _run_cli(fake,
+             'regenerateProfile', '-a', '-q', '-j', '4'), setup)
+
+@benchmark
+def download_all(ctx):
+    path = tempfile.mkdtemp()
+    try:
+        ctx.time('cli_get_profile_all', lambda fake: _run_cli(fake,
+                 'getProfile', '-a', '-q', '-j', '4', '-o', path),
+                 lambda: ctx.portal(devices=min(ctx.scale, 200)))
+    finally:
+        shutil.rmtree(path)
+
+_CLI_USAGE = ('import sys; from portal.cli import console_main; ' +
+              'sys.exit(console_main())')
+
+_CLI_MODULES = '''import sys
+loaded = set(sys.modules)
+from portal.cli import console_main
+try:
+    console_main()
+except SystemExit:
+    pass
+print ' '.join(m for m in sys.modules if m not in loaded and sys.modules[m])
+'''
+
+@benchmark
+def cli_startup(ctx):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(
+            os.path.dirname(os.path.abspath(portal.__file__))))
+    with open(os.devnull, 'w') as devnull:
+        call = lambda *args: subprocess.call((sys.executable, ) + args,
+                env=env, stdout=devnull, stderr=devnull)
+        python = ctx.time('python_startup', lambda: call('-c', 'pass'))
+        # Same as the console script, up to printing the usage
+        cli = ctx.time('cli_startup', lambda: call('-c', _CLI_USAGE))
+        process = subprocess.Popen([ sys.executable, '-c', _CLI_MODULES ],
+                env=env, stdout=subprocess.PIPE, stderr=devnull)
+        modules = process.communicate()[0].split()
+    ctx.check(cli - python <= STARTUP_BUDGET,
+              'cli_startup: %.1fms over the interpreter, budget %.1fms' % (
+              (cli - python) * 1000, STARTUP_BUDGET * 1000))
+    ctx.record('cli_startup_modules', len(modules), 'modules')
+    unwanted = [ m for m in STARTUP_UNWANTED if m in modules ]
+    ctx.check(not unwanted, 'cli_startup: usage loads %s' %
+              ', '.join(unwanted))
+
+def run(scale=5000, repeat=3, pattern=None):
+    ctx = Context(scale, repeat)
+    for fn in BENCHMARKS:
+        if pattern and not re.search(pattern, fn.__name__):
+            continue
+        fn(ctx)
+    return dict(version=portal.__version__, python=platform.python_version(),
+                scale=scale, repeat=repeat, metrics=ctx.metrics,
+                failures=ctx.failures)
+
+def compare(baseline, results, threshold=0.1):
+    # Returns (name, unit, baseline, value, change, regressed) for the
+    # metrics in both, lower values being better
+    rows = []
+    for name in sorted(baseline['metrics']):
+        if name not in results['metrics']:
+            continue
+        base = baseline['metrics'][name]['value']
+        value = results['metrics'][name]['value']
+        change = (value - base) / float(base) if base else 0.0
+        rows.append((name, results['metrics'][name]['unit'], base, value,
+                     change, change > threshold))
+    return rows
+
+def _format(value, unit):
+    if unit == 'bytes':
+        return '%.1fM' % (value / 1048576.0)
+    if unit == 'modules':
+        return '%d' % value
+    return '%.2fms' % (value * 1000)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('run', 'compare'):
+        sys.stderr.write(USAGE)
+        return 2
+    try:
+        if argv[0] == 'run':
+            optlist, args = getopt.getopt(argv[1:], 's:r:k:o:')
+        else:
+            optlist, args = getopt.getopt(argv[1:], 't:')
+        opts = dict((o[1:], a) for o, a in optlist)
+        if argv[0] == 'run':
+            results = run(int(opts.get('s', 5000)), int(opts.get('r', 3)),
+                          opts.get('k'))
+            output = json.dumps(results, indent=2, sort_keys=True)
+            if 'o' in opts:
+                with open(opts['o'], 'w') as f:
+                    f.write(output + '\n')
+            else:
+                print output
+            for failure in results['failures']:
+                print >>sys.stderr, 'portal.bench: %s' % failure
+            return 1 if results['failures'] else 0
+        if len(args) != 2:
+            sys.stderr.write(USAGE)
+            return 2
+        with open(args[0]) as f:
+            baseline = json.load(f)
+        with open(args[1]) as f:
+            results = json.load(f)
+        rows = compare(baseline, results, float(opts.get('t', 0.1)))
+    except (getopt.GetoptError, ValueError, IOError) as e:
+        print >>sys.stderr, 'portal.bench: %s' % e
+        return 2
+    for name, unit, base, value, change, regressed in rows:
+        print '%-30s %10s %10s %+7.1f%%%s' % (name, _format(base, unit),
+                _format(value, unit), change * 100,
+                '  REGRESSED' if regressed else '')
+    return 1 if any(r[-1] for r in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+class BulkResult(object):
+    def __init__(self, item, result=None, error=None):
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BulkResult %r: %r>' % (self.item, self.result)
+        return '<BulkResult %r failed: %r>' % (self.item, self.error)
+
+def execute(fn, items, jobs=1, callback=None, fail_fast=False):
+    def call(item):
+        try:
+            return BulkResult(item, result=fn(item))
+        except Exception as e:
+            return BulkResult(item, error=e)
+
+    def collect(result):
+        results.append(result)
+        if callback:
+            callback(result)
+        if fail_fast and not result.ok:
+            raise result.error
+
+    results = []
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            collect(call(item))
+        return results
+    # Only imported once needed, multiprocessing is slow to load
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        pending = pool.imap_unordered(call, items)
+        while True:
+            try:
+                # A timeout keeps the wait interruptible with ^C
+                result = pending.next(1)
+            except TimeoutError:
+                continue
+            except StopIteration:
+                break
+            collect(result)
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
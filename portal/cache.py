@@ -0,0 +1,148 @@
+from contextlib import contextmanager
+
+import errno
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LISTINGS = ('cert_requests', 'app_ids', 'provisioning_profiles', 'devices')
+
+class DiskCache(object):
+    DEFAULT_TTL = 300
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        if ttl is None or isinstance(ttl, (int, long)):
+            ttl = { None: self.DEFAULT_TTL if ttl is None else ttl }
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def parse_ttl(spec):
+        # "300" or "300,devices=60,provisioning_profiles=600"
+        ttl = {}
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            name, sep, seconds = item.rpartition('=')
+            if sep and name not in LISTINGS:
+                raise ValueError("Unknown listing '%s'" % name)
+            ttl[name or None] = int(seconds)
+        return ttl
+
+    def ttl(self, name):
+        return self._ttl.get(name, self._ttl.get(None, self.DEFAULT_TTL))
+
+    def _path(self, team_id, name):
+        return os.path.join(self.directory, team_id, '%s.json' % name)
+
+    def get(self, team_id, name):
+        value = self._read(self._path(team_id, name), self.ttl(name))
+        if value is not None:
+            self.hits += 1
+        return value
+
+    def get_or_fetch(self, team_id, name, fetch):
+        path = self._path(team_id, name)
+        value = self._read(path, self.ttl(name))
+        if value is None:
+            # Whoever holds the lock fetches, everybody else reuses its result
+            with self._lock(path):
+                value = self._read(path, self.ttl(name))
+                if value is None:
+                    self.misses += 1
+                    value = fetch()
+                    self._write(path, value)
+                    return value
+        self.hits += 1
+        return value
+
+    def put(self, team_id, name, value):
+        path = self._path(team_id, name)
+        with self._lock(path):
+            self._write(path, value)
+
+    def invalidate(self, team_id, name):
+        _remove(self._path(team_id, name))
+
+    def clear(self, team_id=None):
+        for entry in self.entries(team_id):
+            _remove(entry['path'])
+
+    def entries(self, team_id=None):
+        if team_id:
+            teams = [ team_id ]
+        else:
+            try:
+                teams = sorted(os.listdir(self.directory))
+            except OSError:
+                return []
+        entries = []
+        now = time.time()
+        for team in teams:
+            for name in LISTINGS:
+                path = self._path(team, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                age = now - st.st_mtime
+                entries.append(dict(team_id=team, listing=name, path=path,
+                    size=st.st_size, age=age, ttl=self.ttl(name),
+                    fresh=age < self.ttl(name)))
+        return entries
+
+    def _read(self, path, ttl):
+        try:
+            if time.time() - os.path.getmtime(path) >= ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+
+    def _write(self, path, value):
+        _ensure_dir(os.path.dirname(path))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(value, f, default=_to_json)
+        os.rename(tmp, path)
+
+    @contextmanager
+    def _lock(self, path):
+        if fcntl is None:
+            yield
+            return
+        _ensure_dir(os.path.dirname(path))
+        with open('%s.lock' % path, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _to_json(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _ensure_dir(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
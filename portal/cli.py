@@ -1,13 +1,27 @@
 #!/usr/bin/env python
+from collections import Mapping
+
+import errno
 import getopt
 import os
 import re
 import sys
+import threading
 
+# Other modules are imported where used, to keep startup fast
 import portal
 
+SESSION_DIR = os.path.expanduser('~/.portal/sessions')
+CACHE_DIR = os.path.expanduser('~/.portal/cache')
+SOCKET_PATH = os.path.expanduser('~/.portal/daemon.sock')
+MIRROR_DIR = os.path.expanduser('~/.portal/mirror')
+
 opts = {}
-api = portal.API()
+api = None
+# APIs kept across commands by portal serve
+_apis = None
+# Environment, API and standard streams of each thread run with --env
+_local = threading.local()
 
 def error(msg):
     print >>sys.stderr, msg
@@ -18,6 +32,13 @@ def usage():
 
 Global options:
   -d              enable API debug mode
+  -T              print request latency statistics when done
+  --trace FILE    write requests to FILE as a Chrome trace (chrome://tracing)
+  --format FMT    list commands output as text, repr (-r), jsonl, csv or tsv
+  --columns A,B   list commands output these keys (or dotted paths such as
+                  appId.identifier) instead of the default columns
+  --env A,B       run the command for these .portalrc environments at once
+  --all-envs      run the command for every .portalrc environment at once
 
 Certificate Management:
   portal listCertificates [-v | -r]
@@ -25,26 +46,73 @@ Certificate Management:
 Device Management:
   portal listDevices [-v | -r] <filter-criteria>
   portal addDevice [-m name] udid
-  portal deleteDevice <filter-criteria>
-  portal enableDevice <filter-criteria>
+  portal addDevices [-q] [-n] FILE
+  portal deleteDevice [-q] [-n] [-j N] <filter-criteria>
+  portal enableDevice [-q] [-n] [-j N] <filter-criteria>
   filter-criteria: [-m nameregex] [-u udidregex] [ID...]
+  FILE: udid,name lines as CSV or Apple's tab separated format (- for stdin)
 
 App ID Management
   portal listApps [-v | -r]
 
 Provisioning Profile Management:
   portal listProfiles [-v | -r] <filter-criteria>
-  portal getProfile [-a | -i ID] [-o OUTPUT] [-q]
-  portal regenerateProfile [-v | -q] [-n] ( [-a] | <filter-criteria> )
-  portal deleteProfile [-q] [-n] <filter-criteria>
+  portal getProfile [-a [-u] [-j N] | -i ID] [-o OUTPUT] [-q]
+  portal regenerateProfile [-v | -q] [-n] [-j N] ( [-a] | <filter-criteria> )
+  portal deleteProfile [-q] [-n] [-j N] <filter-criteria>
+  portal sync [-v | -q] [-n] [-j N] MANIFEST
   filter-criteria: [-t type] [-i appId] [-m nameregex] [ID...]
 
+Listing Cache:
+  portal cache warm|stats|clear
+
+Local Mirror:
+  portal mirror [-q] [-j N]
+  portal query [-m nameregex] [-u udidregex] [-i appId] [-t type] [-e DAYS]
+               [-w DEVICE] [-x DEVICE] devices|apps|profiles|certificates
+  portal localIndex [-q] [-j N] [-u UDID] [-b DATE] [-i appId] DIR
+
 Miscellaneous:
   portal whoami
+  portal serve [-t TTL] | -k
 
   PORTAL_ENVIRONMENT  Environment variable with .portalrc section to use
                       when connecting to the provisioning portal (defaults
                       to "Default" if unset)
+
+  PORTAL_CACHE_TTL    Enables the on-disk listing cache. Either a number of
+                      seconds or a list such as "300,devices=60" with per
+                      listing overrides (cert_requests, app_ids,
+                      provisioning_profiles, devices)
+  PORTAL_CACHE_DIR    Listing cache location (defaults to ~/.portal/cache)
+  PORTAL_BASE_URL     Talk to another server instead of developer.apple.com,
+                      such as a local fake portal (python -m portal.fakeportal)
+
+  PORTAL_RATE_LIMIT   Maximum requests per second sent to the portal
+  PORTAL_NO_DAEMON    Set to always run commands in process
+
+  Login sessions are kept in ~/.portal/sessions and reused until they expire.
+
+  portal mirror keeps the devices, app ids, profiles (with their devices) and
+  certificates of the team in ~/.portal/mirror, only fetching the details of
+  changed profiles. portal query answers from there without the network:
+  -e DAYS for what expires within DAYS, -w / -x DEVICE (id, UDID or name)
+  for profiles with or without a device.
+
+  portal localIndex lists the .mobileprovision files under DIR, those with
+  device UDID (-u), expiring before DATE (-b YYYY-MM-DD) or for appId (-i).
+  Files are parsed on all cores (-j N for N processes) and indexed in
+  DIR/.portal-index.json, so that only new or changed files are read again.
+
+  With --env or --all-envs every environment logs in with the credentials of
+  its .portalrc section (PORTAL_CREDENTIALS is ignored). Output lines start
+  with the environment name, getProfile -a downloads to a subdirectory per
+  environment and the exit code is the highest of all environments.
+
+  portal serve keeps logged in sessions, listings and connections for every
+  environment in a background process; other commands run in it while it is
+  up (listening on ~/.portal/daemon.sock). Listings are refetched when older
+  than TTL seconds (300 by default); -k stops it.
     """)
 
 def camelcase_to_underscore(name):
@@ -55,17 +123,99 @@ CMDS = {
     'listCertificates': dict(getopt='vr'),
     'listDevices': dict(getopt='vrm:u:'),
     'addDevice': dict(argc=1, getopt='m:'),
-    'deleteDevice': dict(getopt='nqm:u:'),
-    'enableDevice': dict(getopt='nqm:u:'),
+    'addDevices': dict(argc=1, getopt='nq'),
+    'deleteDevice': dict(getopt='nqj:m:u:'),
+    'enableDevice': dict(getopt='nqj:m:u:'),
     'listApps': dict(getopt='vr'),
     'listProfiles': dict(getopt='vrt:i:m:'),
-    'getProfile': dict(getopt='qai:o:'),
-    'regenerateProfile': dict(getopt='vqnat:i:m:'),
-    'deleteProfile': dict(getopt='nqt:i:m:'),
+    'getProfile': dict(getopt='qauj:i:o:'),
+    'regenerateProfile': dict(getopt='vqnaj:t:i:m:'),
+    'deleteProfile': dict(getopt='nqj:t:i:m:'),
+    'sync': dict(argc=1, getopt='vqnj:'),
+    'cache': dict(argc=1, no_login=True),
     'whoami': dict(argc=0),
+    'serve': dict(argc=0, getopt='kt:', no_login=True),
+    'mirror': dict(argc=0, getopt='qj:'),
+    # Works offline, but on the mirror of an environment
+    'query': dict(argc=1, getopt='m:u:i:t:e:w:x:', no_login=True,
+                  environments=True),
+    'localIndex': dict(argc=1, getopt='qj:u:b:i:', no_login=True),
 }
 
+def _make_cache(force=False):
+    spec = os.environ.get('PORTAL_CACHE_TTL')
+    if not spec and not force:
+        return None
+    try:
+        ttl = portal.DiskCache.parse_ttl(spec) if spec else None
+    except ValueError as e:
+        raise CLIError('Invalid PORTAL_CACHE_TTL: %s' % e)
+    return portal.DiskCache(os.environ.get('PORTAL_CACHE_DIR', CACHE_DIR), ttl)
+
+def _make_scheduler():
+    spec = os.environ.get('PORTAL_RATE_LIMIT')
+    if not spec:
+        return None
+    try:
+        rate = float(spec)
+    except ValueError:
+        rate = 0
+    if rate <= 0:
+        raise CLIError('Invalid PORTAL_RATE_LIMIT: %s' % spec)
+    return portal.Scheduler(rate=rate)
+
+def _session_name(environment=None):
+    # Names the session and mirror files of an environment
+    name = environment or os.environ.get('PORTAL_ENVIRONMENT', 'Default')
+    base_url = os.environ.get('PORTAL_BASE_URL')
+    if base_url:
+        import urlparse
+        name += '@' + urlparse.urlparse(base_url).netloc.replace(':', '_')
+    return name
+
+def _make_api(cache=None, environment=None):
+    base_url = os.environ.get('PORTAL_BASE_URL')
+    session_file = os.path.join(SESSION_DIR,
+                                '%s.json' % _session_name(environment))
+    scheduler = _make_scheduler()
+    def make():
+        return portal.API(session_file=session_file,
+                          cache=cache or _make_cache(), base_url=base_url,
+                          scheduler=scheduler, environment=environment)
+    if _apis is not None and cache is None:
+        from portal.daemon import ENVIRONMENT
+        key = tuple(environment if k == 'PORTAL_ENVIRONMENT' and environment
+                    else os.environ.get(k) for k in ENVIRONMENT)
+        return _apis.get(key, make)
+    return make()
+
+def _forward():
+    # Hand the command over to a running portal serve, if any
+    args = sys.argv[1:]
+    if (not args or args[0] == 'serve' or '-' in args or
+            os.environ.get('PORTAL_NO_DAEMON')):
+        return None
+    # Most invocations find no daemon, they should not pay for socket & co
+    if not os.path.exists(SOCKET_PATH):
+        return None
+    import socket
+    import portal.daemon
+    try:
+        return portal.daemon.forward(SOCKET_PATH, args)
+    except (socket.error, EOFError) as e:
+        print >>sys.stderr, 'portal serve unavailable (%s), running locally' % e
+        return None
+
+def console_main():
+    # The portal command. Only this hands commands over to portal serve,
+    # main() always runs them in this process.
+    rc = _forward()
+    if rc is not None:
+        return rc
+    return main()
+
 def main():
+    global api
     try:
         sys.argv.pop(0)
         if not sys.argv:
@@ -80,10 +230,26 @@ def main():
         cmd_fn = globals()[fn_name]
         args = sys.argv
         spec = cmd_entry.get('getopt', '')
-        spec = 'd' + spec
-        optlist, args = getopt.getopt(args, spec)
-        opts.update(dict((o[1:], a or True) for o, a in optlist))
-        api.debug = 'd' in opts
+        spec = 'dT' + spec
+        long_spec = [ 'trace=', 'format=', 'columns=', 'env=', 'all-envs' ]
+        optlist, args = getopt.getopt(args, spec, long_spec)
+        # Flags are set to True, other options keep their argument
+        flags = set(c for i, c in enumerate(spec)
+                    if c != ':' and spec[i + 1:i + 2] != ':')
+        flags.update(o for o in long_spec if not o.endswith('='))
+        for o, a in optlist:
+            name = o.lstrip('-')
+            if name in flags:
+                opts[name] = True
+            elif not a:
+                raise CLIError('%s needs a value' % o)
+            else:
+                opts[name] = a
+        if 'format' in opts:
+            from portal.output import FORMATS
+            if opts['format'] not in FORMATS:
+                error("Unknown format '%s', expected one of %s" % (
+                    opts['format'], ', '.join(FORMATS)))
         argc_spec = cmd_entry.get('argc')
         if argc_spec:
             argc = len(args)
@@ -92,9 +258,31 @@ def main():
             if not argc_spec[0] <= argc <= argc_spec[1]:
                 error("Incorrect args for '%s': Got %s, expected %s" %
                     (cmd, argc, argc_spec))
+        if 'env' in opts or 'all-envs' in opts:
+            if (cmd_entry.get('no_login', False) and
+                    not cmd_entry.get('environments', False)):
+                raise CLIError('--env and --all-envs need a portal command')
+            return _fan_out(cmd, cmd_fn, args,
+                            not cmd_entry.get('no_login', False))
+        # Only commands talking to the portal get an API (cache makes its own)
+        api, hooks = None, []
         if not cmd_entry.get('no_login', False):
-            api.login()
-        return cmd_fn(*args)
+            api = _make_api()
+            api.debug = 'd' in opts
+            traced, hooks = api, _trace_hooks()
+            for hook in hooks:
+                api.add_hook(hook)
+        try:
+            # APIs kept by portal serve are logged in already
+            if api is not None and getattr(api, 'team_id', None) is None:
+                api.login()
+            return cmd_fn(*args)
+        finally:
+            if hooks:
+                _report_trace([ traced ], hooks)
+    except SystemExit:
+        # Before portal.APIException below imports the API
+        raise
     except KeyboardInterrupt:
         sys.exit(3)
     except getopt.GetoptError as e:
@@ -104,138 +292,383 @@ def main():
 
 class CLIError(Exception): pass
 
+def _trace_hooks():
+    hooks = []
+    if 'T' in opts:
+        hooks.append(portal.LatencyStats())
+    if 'trace' in opts:
+        hooks.append(portal.ChromeTrace())
+    return hooks
+
+def _report_trace(traced, hooks):
+    for hook in hooks:
+        for traced_api in traced:
+            traced_api.remove_hook(hook)
+        if isinstance(hook, portal.LatencyStats):
+            print >>sys.stderr, hook.summary()
+            continue
+        try:
+            hook.write(opts['trace'])
+        except IOError as e:
+            print >>sys.stderr, 'Unable to write trace to %s: %s' % (
+                    opts['trace'], e.strerror)
+
+class _PerThread(object):
+    # Stands in for the object a thread keeps as _local.<name>, default in
+    # other threads. Threads started by commands see the default: they need
+    # to be handed what they use of the API (bound methods and the like).
+    def __init__(self, name, default=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_default', default)
+
+    def _target(self):
+        return getattr(_local, self._name, self._default)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._target(), name, value)
+
+class _PrefixedWriter(object):
+    # Writes whole lines to stream, each starting with prefix
+    def __init__(self, stream, prefix, lock):
+        self._stream = stream
+        self._prefix = prefix
+        self._lock = lock
+        self._partial = ''
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        if lines:
+            with self._lock:
+                self._stream.write(''.join('%s%s\n' % (self._prefix, line)
+                                           for line in lines))
+
+    def flush(self):
+        with self._lock:
+            self._stream.flush()
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        if self._partial:
+            self.write('\n')
+        self.flush()
+
+def _environments():
+    if 'all-envs' in opts:
+        if 'env' in opts:
+            raise CLIError('Either --env or --all-envs')
+        import ConfigParser
+        from portal.api import portalrc_environments
+        try:
+            environments = portalrc_environments()
+        except ConfigParser.Error as e:
+            raise CLIError('Unable to read .portalrc: %s' % e)
+        if not environments:
+            raise CLIError('No environments in .portalrc')
+        return environments
+    environments = []
+    for environment in opts['env'].split(','):
+        if environment.strip() and environment.strip() not in environments:
+            environments.append(environment.strip())
+    if not environments:
+        raise CLIError('No environments given')
+    return environments
+
+def _run_environment(cmd, cmd_fn, args, environment, login, hooks, apis):
+    # Runs the command in the current thread, with an API of its own
+    try:
+        _local.environment = environment
+        if login:
+            _local.api = env_api = _make_api(environment=environment)
+            apis.append(env_api)
+            env_api.debug = 'd' in opts
+            for hook in hooks:
+                env_api.add_hook(hook)
+            if getattr(env_api, 'team_id', None) is None:
+                env_api.login()
+        return cmd_fn(*args) or 0
+    except SystemExit as e:
+        # error() printed the message already
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print >>sys.stderr, e.code
+        return 1
+    except (CLIError, portal.APIException) as e:
+        print >>sys.stderr, 'portal %s: %s' % (cmd, e.message)
+        return 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+
+def _fan_out(cmd, cmd_fn, args, login=True):
+    # Runs the command for every environment at once, each in its thread
+    # with an API of its own and output lines prefixed with its name
+    global api
+    environments = _environments()
+    width = max(len(e) for e in environments) + 1
+    lock = threading.Lock()
+    hooks = _trace_hooks()
+    apis, rcs, writers = [], {}, []
+    saved = api, sys.stdout, sys.stderr
+    def run(environment):
+        prefix = '%-*s ' % (width, environment + ':')
+        _local.stdout = _PrefixedWriter(saved[1], prefix, lock)
+        _local.stderr = _PrefixedWriter(saved[2], prefix, lock)
+        writers.extend((_local.stdout, _local.stderr))
+        rcs[environment] = _run_environment(cmd, cmd_fn, args, environment,
+                                            login, hooks, apis)
+    threads = [ threading.Thread(target=run, args=(e, ))
+                for e in environments ]
+    api = _PerThread('api')
+    sys.stdout = _PerThread('stdout', saved[1])
+    sys.stderr = _PerThread('stderr', saved[2])
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # With a timeout so that Ctrl-C still gets through
+            while thread.is_alive():
+                thread.join(1)
+    finally:
+        for writer in writers:
+            writer.close()
+        api, sys.stdout, sys.stderr = saved
+        if hooks:
+            _report_trace(apis, hooks)
+    failed = [ e for e in environments if rcs.get(e, 1) ]
+    if failed:
+        print >>sys.stderr, 'portal %s: failed for %s' % (cmd,
+                ', '.join(failed))
+    return max(rcs.get(e, 1) for e in environments)
+
+def _output(columns, computed=None):
+    # Writer for the rows of list commands, columns being the default ones
+    from portal.output import Writer, parse_columns
+    fmt = opts.get('format') or ('repr' if 'r' in opts else 'text')
+    try:
+        if 'columns' in opts:
+            columns = parse_columns(opts['columns'])
+        elif fmt in ('repr', 'jsonl'):
+            columns = None
+        return Writer(getattr(_local, 'stdout', sys.stdout), fmt, columns,
+                      computed)
+    except ValueError as e:
+        raise CLIError(str(e))
+
 def cmd_list_certificates():
     keys = ('certificateId expirationDate dateRequested dateCreated ' +
             'statusString typeString name' if 'v' in opts else
             'certificateId expirationDate typeString name').split()
-    certs = api.list_cert_requests(typ=
-        [api.CERT_TYPE_IOS_DEVELOPMENT, api.CERT_TYPE_IOS_DISTRIBUTION])
-    for certificate in certs:
-        if 'r' in opts:
-            print certificate
-        else:
-            print '\t'.join(certificate[k] for k in keys)
+    certs = api.iter_cert_requests(
+        lambda c: c['certificateTypeDisplayId'] in api.CERT_TYPE_IOS)
+    with _output(keys) as out:
+        for certificate in certs:
+            out.writerow(certificate)
+
+def _feature_flag(feature):
+    return lambda app: 'X' if app['features'].get(feature) else ''
 
 def cmd_list_apps():
     keys = ('appIdId f1 f2 f3 f4 f5 f6 identifier name' if 'v' in opts else
             'appIdId identifier name').split()
     fkeys = 'inAppPurchase iCloud gameCenter push passbook dataProtection'.split()
-    for app in api.all_app_ids():
-        if 'r' in opts:
-            print app
-        else:
-            if 'v' in opts:
-                features = app['features']
-                app.update({'f%d' % i: 'X' for i, k in enumerate(fkeys) if features[k]})
-            print '\t'.join(app.get(k, '') for k in keys)
+    flags = dict(('f%d' % i, _feature_flag(k))
+                 for i, k in enumerate(fkeys, 1))
+    with _output(keys, flags) as out:
+        for app in api.iter_app_ids():
+            out.writerow(app)
 
 def cmd_list_devices(*args):
     rc = 0
     keys = ('deviceId status deviceNumber name' if 'v' in opts else
             'deviceNumber name').split()
-    for device in _filter_devices(args, include_all=True):
-        if isinstance(device, basestring):
-            print >>sys.stderr, "Device '%s' not found" % device
-            rc = 1
-            continue
-        if 'r' in opts:
-            print device
-        else:
-            print '\t'.join(device[k] for k in keys)
+    if args:
+        devices = _filter_devices(args)
+    else:
+        devices = api.iter_devices(_device_predicate())
+    with _output(keys) as out:
+        for device in devices:
+            if isinstance(device, basestring):
+                print >>sys.stderr, "Device '%s' not found" % device
+                rc = 1
+                continue
+            out.writerow(device)
     return rc
 
 def cmd_add_device(udid):
     api.add_device(udid, name=opts.get('m'))
 
-def cmd_delete_device(*args):
-    rc = 0
-    for device in _filter_devices(args):
-        if isinstance(device, dict):
-            if 'q' not in opts:
-                print >>sys.stderr, "Deleting device '%s'" % device['deviceNumber']
-            if 'n' not in opts:
-                api.delete_device(device)
+def cmd_add_devices(filename):
+    import portal.devicefile
+    try:
+        if filename == '-':
+            devices = list(portal.devicefile.parse(sys.stdin))
         else:
-            print >>sys.stderr, "Device '%s' not found" % device
-            rc = 1
-    return rc
+            devices = portal.devicefile.read(filename)
+    except IOError as e:
+        raise CLIError('Unable to read %s: %s' % (filename, e.strerror))
+    pending = api.unregistered_devices(devices)
+    if 'q' not in opts:
+        for udid, name in pending:
+            print >>sys.stderr, "Adding device '%s' (%s)" % (udid, name)
+    if 'n' not in opts:
+        api.add_devices(pending)
+    if 'q' not in opts:
+        print >>sys.stderr, '%s %s, %d already registered or duplicated' % (
+                'Would add' if 'n' in opts else 'Added',
+                _plural(len(pending), 'device'), len(devices) - len(pending))
+
+def cmd_delete_device(*args):
+    devices, rc = _found(_filter_devices(args), 'Device')
+    return _bulk(api.delete_device, devices, 'delete', 'device',
+            lambda d: "device '%s'" % d['deviceNumber']) or rc
 
 def cmd_enable_device(*args):
-    rc = 0
-    for device in _filter_devices(args):
-        if isinstance(device, dict):
-            if 'q' not in opts:
-                print >>sys.stderr, "Enabling device '%s'" % device['deviceNumber']
-            if 'n' not in opts:
-                api.enable_device(device)
+    devices, rc = _found(_filter_devices(args), 'Device')
+    return _bulk(api.enable_device, devices, 'enable', 'device',
+            lambda d: "device '%s'" % d['deviceNumber']) or rc
+
+def _found(items, label):
+    found, rc = [], 0
+    for item in items:
+        if isinstance(item, Mapping):
+            found.append(item)
         else:
-            print >>sys.stderr, "Device '%s' not found" % device
+            print >>sys.stderr, "%s '%s' not found" % (label, item)
             rc = 1
-    return rc
+    return found, rc
+
+def _plural(count, noun):
+    return '%d %s%s' % (count, noun, '' if count == 1 else 's')
+
+def _bulk(fn, items, action, noun, describe, progress=False):
+    gerund = '%sing' % action[:-1].capitalize()
+    if 'n' in opts:
+        fn = lambda item: None
+    done = [ 0 ]
+    def report(result):
+        done[0] += 1
+        if not result.ok:
+            print >>sys.stderr, '\rUnable to %s %s: %s' % (
+                    action, describe(result.item), result.error)
+        elif 'q' in opts:
+            pass
+        elif progress and 'v' not in opts:
+            print >>sys.stderr, '\r%s %d/%d %ss (%d%%)' % (gerund, done[0],
+                    len(items), noun, done[0] * 100 / len(items)),
+        else:
+            print >>sys.stderr, '%s %s' % (gerund, describe(result.item))
+    results = api.bulk(fn, items, jobs=_jobs(), callback=report)
+    failed = len([ r for r in results if not r.ok ])
+    if results and 'q' not in opts:
+        if progress and 'v' not in opts:
+            print >>sys.stderr
+        if 'n' in opts:
+            print >>sys.stderr, 'Would %s %s' % (action,
+                    _plural(len(results), noun))
+        else:
+            print >>sys.stderr, '%sd %s, %d failed' % (action.capitalize(),
+                    _plural(len(results) - failed, noun), failed)
+    return 1 if failed else 0
 
 def _filter_devices(args, include_all=False):
     if not args and ('m' in opts or 'u' in opts or include_all):
         devices = api.all_devices()
     else:
         devices = api.get_device(args, return_id_if_missing=True)
-    if 'm' in opts:
-        devices = [ d for d in devices
-                    if not isinstance(d, dict) or
-                        re.search(opts['m'], d['name'], re.I) ]
-    if 'u' in opts:
-        devices = [ d for d in devices
-                    if not isinstance(d, dict) or
-                        re.search(opts['u'], d['deviceNumber'], re.I) ]
-    return devices
+    match = _device_predicate()
+    return [ d for d in devices if not isinstance(d, Mapping) or match(d) ]
+
+def _device_predicate():
+    def match(device):
+        return (('m' not in opts or
+                    re.search(opts['m'], device['name'], re.I)) and
+                ('u' not in opts or
+                    re.search(opts['u'], device['deviceNumber'], re.I)))
+    return match
 
 def cmd_list_profiles(*args):
     rc = 0
-    for profile in _filter_profiles(args, include_all=True):
-        if isinstance(profile, basestring):
-            print >>sys.stderr, "Profile '%s' not found" % profile
-            rc = 1
-            continue
-        if 'r' in opts:
-            print profile
-        elif 'v' in opts:
-            print '\t'.join(str(v) for v in (
-                profile['provisioningProfileId'],
-                profile['status'],
-                profile['certificateCount'],
-                profile['deviceCount'],
-                profile['dateExpire'],
-                api.profile_type_name(profile),
-                profile['appId']['identifier'],
-                profile['name']))
-        else:
-            print '\t'.join((
-                profile['provisioningProfileId'],
-                api.profile_type_name(profile),
-                profile['appId']['identifier'],
-                profile['name']))
+    keys = ('provisioningProfileId status certificateCount deviceCount ' +
+            'dateExpire profileType appId.identifier name' if 'v' in opts else
+            'provisioningProfileId profileType appId.identifier name').split()
+    if args:
+        profiles = _filter_profiles(args)
+    else:
+        profiles = api.iter_provisioning_profiles(_profile_predicate())
+    with _output(keys, dict(profileType=api.profile_type_name)) as out:
+        for profile in profiles:
+            if isinstance(profile, basestring):
+                print >>sys.stderr, "Profile '%s' not found" % profile
+                rc = 1
+                continue
+            out.writerow(profile)
     return rc
 
+def _jobs():
+    try:
+        jobs = int(opts.get('j', 1))
+    except ValueError:
+        raise CLIError("Invalid job count '%s'" % opts['j'])
+    if jobs < 1:
+        raise CLIError("Invalid job count '%s'" % opts['j'])
+    return jobs
+
+def _profile_filename(path, profile):
+    identifier = profile['appId']['identifier']
+    filename = '%s.mobileprovision' % api.profile_type_name(profile)
+    if identifier == '*':
+        return os.path.join(path, filename)
+    return os.path.join(path, identifier, filename)
+
 def cmd_get_profile():
     if 'a' in opts:
-        lf_pending = False
         if 'i' in opts:
             raise CLIError("-i may not be specified with -a")
         path = opts.get('o', os.getcwd())
+        # Teams have profiles for the same app ids
+        if getattr(_local, 'environment', None):
+            path = os.path.join(path, _local.environment)
         profiles = api.all_provisioning_profiles()
-        for ix, profile in enumerate(profiles):
-            identifier = profile['appId']['identifier']
-            filename = '%s.mobileprovision' % api.profile_type_name(profile)
-            if identifier == '*':
-                filename = os.path.join(path, filename)
-            else:
-                filename = os.path.join(path, identifier, filename)
-            api.download_profile(profile, filename)
+        downloads = [ (p, _profile_filename(path, p)) for p in profiles ]
+        # Profiles of the same app id and type share a file, the last one
+        # listed gets it whatever the number of jobs
+        owners = dict((f, p) for p, f in downloads)
+        downloads = [ (p, f) for p, f in downloads if owners[f] is p ]
+        total = len(downloads)
+        manifest = portal.ProfileManifest(path)
+        if 'u' in opts:
+            downloads = [ (p, f) for p, f in downloads
+                          if not manifest.is_current(p, f) ]
+            for profile_id, filename in manifest.missing(profiles):
+                print >>sys.stderr, "Profile '%s' no longer exists (%s)" % (
+                        profile_id, filename)
+        done = [ 0 ]
+        def progress(profile, filename):
+            manifest.update(profile, filename)
+            done[0] += 1
             if 'q' not in opts:
                 print >>sys.stderr, '\rDownloading %d/%d profiles (%d%%)' % (
-                        ix + 1, len(profiles), (ix + 1) * 100 / len(profiles)),
-                lf_pending = True
-        if lf_pending:
-            print >>sys.stderr
+                        done[0], len(downloads), done[0] * 100 / len(downloads)),
+        try:
+            api.download_profiles(downloads, jobs=_jobs(), callback=progress)
+        finally:
+            manifest.save()
+            if done[0] and 'q' not in opts:
+                print >>sys.stderr
+        if 'u' in opts and 'q' not in opts:
+            print >>sys.stderr, 'Downloaded %s, %d up to date' % (
+                    _plural(done[0], 'profile'), total - len(downloads))
     elif 'i' in opts:
         api.download_profile(opts['i'], opts.get('o', sys.stdout))
     else:
@@ -244,12 +677,13 @@ def cmd_get_profile():
 def cmd_regenerate_profile(*args):
     if not args and 'a' not in opts:
         raise CLIError('Must specify at least one profile (or use -a)')
-    lf_pending = False
     dev_certs = api.list_cert_requests(typ=api.CERT_TYPE_IOS_DEVELOPMENT)
     dist_certs = api.list_cert_requests(typ=api.CERT_TYPE_IOS_DISTRIBUTION)
     devices = api.all_devices()
-    profiles =  list(_filter_profiles(args, include_all='a' in opts))
-    for ix, profile in enumerate(profiles):
+    profiles, rc = _found(_filter_profiles(args, include_all='a' in opts),
+            'Profile')
+    updates = []
+    for profile in profiles:
         profile_id = profile['provisioningProfileId']
         if 'a' not in opts and profile_id not in args:
             continue
@@ -262,51 +696,230 @@ def cmd_regenerate_profile(*args):
                         profile_id, profile['name'])
             continue
         certs = dev_certs if profile_type == 'development' else dist_certs
-        if 'v' not in opts and 'q' not in opts:
-            print >>sys.stderr, '\rRegenerating %d/%d profiles (%d%%)' % (
-                    ix + 1, len(profiles), (ix + 1 ) * 100 / len(profiles)),
-            lf_pending = True
-        if 'v' in opts:
-            print >>sys.stderr, 'Regenerating %s (%s)' % (
-                    profile_id, profile['name'])
-        if 'n' not in opts:
-            api.update_provisioning_profile(profile,
-                    device_ids=devs, certificate_ids=certs)
-    if lf_pending:
-        print >>sys.stderr
+        updates.append((profile, devs, certs))
+    # Bound here, the workers running it don't know the environment's API
+    update_provisioning_profile = api.update_provisioning_profile
+    def regenerate(update):
+        profile, devs, certs = update
+        update_provisioning_profile(profile,
+                device_ids=devs, certificate_ids=certs)
+    return _bulk(regenerate, updates, 'regenerate', 'profile',
+            lambda u: '%s (%s)' % (u[0]['provisioningProfileId'],
+                u[0]['name']), progress=True) or rc
 
 def cmd_delete_profile(*args):
-    rc = 0
-    for profile in _filter_profiles(args):
-        if isinstance(profile, dict):
-            if 'q' not in opts:
-                print >>sys.stderr, "Deleting profile '%s'" % profile['provisioningProfileId']
-            if 'n' not in opts:
-                api.delete_provisioning_profile(profile)
-        else:
-            print >>sys.stderr, "Profile '%s' not found" % profile
-            rc = 1
-    return rc
+    profiles, rc = _found(_filter_profiles(args), 'Profile')
+    return _bulk(api.delete_provisioning_profile, profiles, 'delete',
+            'profile', lambda p: "profile '%s'" % p['provisioningProfileId']) or rc
+
+def _describe_change(change):
+    if change.profile:
+        return '%s (%s)' % (change.profile['provisioningProfileId'],
+                change.profile['name'])
+    return "'%s'" % change.name
+
+def _change_details(change):
+    details = []
+    for noun, added, removed in (
+            ('devices', change.added_devices, change.removed_devices),
+            ('certificates', change.added_certificates,
+                change.removed_certificates)):
+        if change.action == portal.sync.CREATE:
+            details.append('%d %s' % (len(added), noun))
+        elif added or removed:
+            details.append('+%d -%d %s' % (len(added), len(removed), noun))
+    if change.reason:
+        details.insert(0, change.reason)
+    return ', '.join(details)
+
+def cmd_sync(filename):
+    import portal.sync
+    try:
+        manifest = portal.sync.load(filename)
+    except IOError as e:
+        raise CLIError('Unable to read %s: %s' % (filename, e.strerror))
+    except ValueError as e:
+        raise CLIError('Invalid manifest: %s' % e)
+    try:
+        changes = api.plan(manifest, jobs=_jobs())
+    except ValueError as e:
+        raise CLIError(str(e))
+    pending = [ c for c in changes if c.action != portal.sync.KEEP ]
+    if 'q' not in opts:
+        for change in changes:
+            if change.action != portal.sync.KEEP or 'v' in opts:
+                print '\t'.join((change.action,
+                        api.profile_type_name(change.profile_type),
+                        _describe_change(change), _change_details(change)))
+        print >>sys.stderr, '%s to apply, %d up to date' % (
+                _plural(len(pending), 'change'), len(changes) - len(pending))
+    return _bulk(api.apply_change, pending, 'update', 'profile',
+            lambda c: 'profile %s [%s]' % (_describe_change(c), c.action))
 
 def _filter_profiles(args, include_all=False):
-    if not args and ('m' in opts or 'i' in opts or 't' in opts or include_all):
+    if not args and 'i' in opts and 't' in opts:
+        profiles = api.find_provisioning_profiles(opts['i'], opts['t'])
+    elif not args and ('m' in opts or 'i' in opts or 't' in opts or include_all):
         profiles = api.all_provisioning_profiles()
     else:
         profiles = api.get_provisioning_profile(args, return_id_if_missing=True)
-    if 'm' in opts:
-        profiles = [ p for p in profiles
-                     if not isinstance(p, dict) or
-                         re.search(opts['m'], p['name'], re.I) ]
-    if 'i' in opts:
-        profiles = [ p for p in profiles
-                     if not isinstance(p, dict) or
-                         p['appId']['identifier'] == opts['i'] ]
-    if 't' in opts:
-        profile_type = api.profile_type(opts['t'])
-        profiles = [ p for p in profiles
-                     if not isinstance(p, dict) or
-                         api.profile_type(p) == profile_type ]
-    return profiles
+    match = _profile_predicate()
+    return [ p for p in profiles if not isinstance(p, Mapping) or match(p) ]
+
+def _profile_predicate():
+    profile_type = api.profile_type(opts['t']) if 't' in opts else None
+    def match(profile):
+        return (('m' not in opts or
+                    re.search(opts['m'], profile['name'], re.I)) and
+                ('i' not in opts or
+                    profile['appId']['identifier'] == opts['i']) and
+                (profile_type is None or
+                    api.profile_type(profile) == profile_type))
+    return match
+
+def cmd_cache(action):
+    global api
+    cache = _make_cache(force=True)
+    if _apis is not None and action in ('warm', 'clear'):
+        _apis.clear()
+    if action == 'warm':
+        api = _make_api(cache)
+        api.login()
+        api.clear_cache()
+        api.all_cert_requests()
+        api.all_app_ids()
+        api.all_provisioning_profiles()
+        api.all_devices()
+    elif action == 'stats':
+        for entry in cache.entries():
+            print '\t'.join(str(v) for v in (
+                entry['team_id'],
+                entry['listing'],
+                'fresh' if entry['fresh'] else 'stale',
+                int(entry['age']),
+                entry['ttl'],
+                entry['size']))
+    elif action == 'clear':
+        cache.clear()
+    else:
+        raise CLIError("Unknown cache action '%s'" % action)
+
+def _mirror_filename():
+    return os.path.join(MIRROR_DIR, '%s.sqlite' %
+                        _session_name(getattr(_local, 'environment', None)))
+
+def cmd_mirror():
+    from portal.mirror import Mirror
+    filename = _mirror_filename()
+    try:
+        os.makedirs(MIRROR_DIR, 0700)
+    except OSError as e:
+        # Mirrors of other environments may be starting as well
+        if e.errno != errno.EEXIST:
+            raise
+    # The mirror should match the portal, not the listing cache
+    api.refresh_listings()
+    with Mirror(filename) as mirror:
+        stats = mirror.refresh(api, jobs=_jobs() if 'j' in opts else 8)
+    if 'q' not in opts:
+        for table in sorted(stats):
+            print >>sys.stderr, '%-12s %d added, %d updated, %d removed, ' \
+                    '%d unchanged' % (table + ':', stats[table].added,
+                    stats[table].updated, stats[table].removed,
+                    stats[table].unchanged)
+
+_QUERY_COLUMNS = dict(
+    devices='deviceId status deviceNumber name',
+    app_ids='appIdId identifier name',
+    profiles='provisioningProfileId dateExpire profileType appId.identifier name',
+    certificates='certificateId expirationDate typeString name')
+_QUERY_TABLES = dict(devices='devices', apps='app_ids', profiles='profiles',
+                     certificates='certificates')
+
+def cmd_query(table):
+    from portal.mirror import Mirror
+    if table not in _QUERY_TABLES:
+        raise CLIError("Unknown table '%s', expected one of %s" % (table,
+                ', '.join(sorted(_QUERY_TABLES))))
+    table = _QUERY_TABLES[table]
+    filename = _mirror_filename()
+    if not os.path.exists(filename):
+        raise CLIError('No mirror in %s, run portal mirror first' % filename)
+    try:
+        expires_within = int(opts['e']) if 'e' in opts else None
+    except ValueError:
+        raise CLIError("Invalid number of days '%s'" % opts['e'])
+    with Mirror(filename) as mirror:
+        try:
+            rows = mirror.query(table, name=opts.get('m'), udid=opts.get('u'),
+                    identifier=opts.get('i'), profile_type=opts.get('t'),
+                    expires_within=expires_within, with_device=opts.get('w'),
+                    without_device=opts.get('x'))
+            with _output(_QUERY_COLUMNS[table].split()) as out:
+                for row in rows:
+                    out.writerow(row)
+        except ValueError as e:
+            raise CLIError(str(e))
+
+def cmd_local_index(path):
+    from datetime import datetime
+    from portal.localindex import LocalIndex
+    if not os.path.isdir(path):
+        raise CLIError("No such directory '%s'" % path)
+    expires_before = opts.get('b')
+    if expires_before is not None:
+        try:
+            datetime.strptime(expires_before, '%Y-%m-%d')
+        except ValueError:
+            raise CLIError("Invalid date '%s', expected YYYY-MM-DD" %
+                           expires_before)
+    index = LocalIndex(path)
+    stats = index.scan(jobs=_jobs() if 'j' in opts else None)
+    try:
+        index.save()
+    except (IOError, OSError) as e:
+        print >>sys.stderr, 'Unable to save %s: %s' % (index.filename,
+                                                       e.strerror)
+    if 'q' not in opts:
+        print >>sys.stderr, '%d parsed, %d cached, %d removed, %d failed' % (
+                stats.parsed, stats.cached, stats.removed, len(stats.failed))
+    for filename, error in stats.failed:
+        print >>sys.stderr, '%s: %s' % (filename, error)
+    profiles = index.query(udid=opts.get('u'), expires_before=expires_before,
+                           app_id=opts.get('i'))
+    with _output('UUID ExpirationDate profileType applicationIdentifier '
+                 'Name path'.split()) as out:
+        for profile in profiles:
+            out.writerow(profile)
+    return 1 if stats.failed else 0
 
 def cmd_whoami(*args):
     print '%s (%s)' % (api.user, api.team_id)
+
+def _serve_command(argv):
+    sys.argv = [ 'portal' ] + argv
+    opts.clear()
+    return main()
+
+def cmd_serve():
+    global _apis
+    import signal
+    import socket
+    import portal.daemon
+    if 'k' in opts:
+        if not portal.daemon.stop(SOCKET_PATH):
+            raise CLIError('Not running')
+        return
+    try:
+        ttl = int(opts.get('t', 300))
+    except ValueError:
+        raise CLIError("Invalid listing TTL '%s'" % opts['t'])
+    daemon = portal.daemon.Daemon(SOCKET_PATH, _serve_command)
+    try:
+        daemon.bind()
+    except (IOError, OSError, socket.error) as e:
+        raise CLIError('Unable to listen on %s: %s' % (SOCKET_PATH, e.strerror))
+    _apis = portal.daemon.APIPool(ttl)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print >>sys.stderr, 'Serving on %s' % SOCKET_PATH
+    daemon.serve_forever()
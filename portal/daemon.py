@@ -0,0 +1,222 @@
+# `portal serve` keeps logged in API instances, with their listings and
+# connections, in a long running process. CLI invocations send it their
+# arguments over a Unix socket and get back their output as frames of
+#
+#   type (1 byte) | length (4 bytes, big endian) | payload
+#
+# 'r' carries the JSON request, 'o' and 'e' stdout and stderr data, 'x' the
+# exit code and 'k' asks the daemon to stop.
+import errno
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+
+# Environment the CLI depends on, passed along with each request
+ENVIRONMENT = ('PORTAL_ENVIRONMENT PORTAL_CREDENTIALS PORTAL_CACHE_TTL ' +
+        'PORTAL_CACHE_DIR PORTAL_BASE_URL PORTAL_RATE_LIMIT').split()
+
+_HEADER = struct.Struct('>cI')
+
+def _send_frame(sock, typ, payload=''):
+    sock.sendall(_HEADER.pack(typ, len(payload)) + payload)
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Connection closed')
+        data += chunk
+    return data
+
+def _recv_frame(sock):
+    typ, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return typ, _recv_exactly(sock, size)
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return sock
+
+def forward(path, argv):
+    # Runs a CLI command in the daemon listening on path, relaying its
+    # output. Returns its exit code, or None when no daemon is running.
+    sock = _connect(path)
+    if sock is None:
+        return None
+    try:
+        request = dict(argv=argv, cwd=os.getcwd(),
+                env=dict((k, os.environ[k]) for k in ENVIRONMENT
+                         if k in os.environ))
+        _send_frame(sock, 'r', json.dumps(request))
+        while True:
+            typ, payload = _recv_frame(sock)
+            if typ == 'o':
+                sys.stdout.write(payload)
+                sys.stdout.flush()
+            elif typ == 'e':
+                sys.stderr.write(payload)
+                sys.stderr.flush()
+            elif typ == 'x':
+                return int(payload)
+    finally:
+        sock.close()
+
+def stop(path):
+    sock = _connect(path)
+    if sock is None:
+        return False
+    try:
+        _send_frame(sock, 'k')
+        _recv_frame(sock)
+    finally:
+        sock.close()
+    return True
+
+class _FrameWriter(object):
+    # File-like stand-in for stdout/stderr while serving a request
+    def __init__(self, sock, typ):
+        self._sock = sock
+        self._typ = typ
+        self._lock = threading.Lock()
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            with self._lock:
+                _send_frame(self._sock, self._typ, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class Daemon(object):
+    def __init__(self, path, run):
+        # run(argv) executes a CLI command, returning its exit code
+        self.path = path
+        self.run = run
+        self._sock = None
+
+    def bind(self):
+        sock = _connect(self.path)
+        if sock is not None:
+            sock.close()
+            raise IOError(errno.EADDRINUSE, 'Already running', self.path)
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent, 0700)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the owner may use the sessions held by the daemon
+        umask = os.umask(0077)
+        try:
+            self._sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self._sock.listen(64)
+
+    def serve_forever(self):
+        try:
+            while True:
+                conn, _ = self._sock.accept()
+                try:
+                    if not self._handle(conn):
+                        break
+                except (socket.error, EOFError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            self._sock.close()
+            os.remove(self.path)
+
+    def _handle(self, conn):
+        typ, payload = _recv_frame(conn)
+        if typ == 'k':
+            _send_frame(conn, 'x', '0')
+            return False
+        if typ != 'r':
+            return True
+        request = json.loads(payload)
+        rc = self._execute(conn, request)
+        _send_frame(conn, 'x', str(rc))
+        return True
+
+    def _execute(self, conn, request):
+        # Requests are served one at a time: the process wide cwd, environment
+        # and standard streams are switched over to the client's
+        saved_env = dict((k, os.environ.get(k)) for k in ENVIRONMENT)
+        saved_cwd = os.getcwd()
+        saved_streams = sys.stdout, sys.stderr
+        try:
+            for k in ENVIRONMENT:
+                os.environ.pop(k, None)
+            os.environ.update(dict((str(k), str(v))
+                                   for k, v in request['env'].items()))
+            os.chdir(request['cwd'])
+            sys.stdout = _FrameWriter(conn, 'o')
+            sys.stderr = _FrameWriter(conn, 'e')
+            try:
+                return self.run([ str(a) for a in request['argv'] ]) or 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print >>sys.stderr, e.code
+                return 1
+            except (socket.error, EOFError):
+                raise
+            except Exception:
+                traceback.print_exc()
+                return 1
+        finally:
+            sys.stdout, sys.stderr = saved_streams
+            os.chdir(saved_cwd)
+            for k, v in saved_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+class APIPool(object):
+    # One API per environment (as given by the PORTAL_* variables), whose
+    # in memory listings are dropped once older than ttl seconds
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._apis = {}
+
+    def get(self, key, factory):
+        entry = self._apis.get(key)
+        now = time.time()
+        if entry is None:
+            entry = self._apis[key] = [ factory(), now ]
+        elif self.ttl is not None and now - entry[1] > self.ttl:
+            entry[0].clear_cache(disk=False)
+            entry[1] = now
+        return entry[0]
+
+    def clear(self):
+        for api, _ in self._apis.values():
+            api.clear_cache(disk=False)
@@ -0,0 +1,25 @@
+import csv
+
+_HEADERS = ('device id', 'deviceid', 'udid', 'device number')
+
+def parse(lines):
+    # Apple's tab separated upload format or plain CSV, one
+    # "udid<sep>name" per line, optionally preceded by a header line
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '\t' in line:
+            fields = line.split('\t')
+        else:
+            fields = next(csv.reader([ line ]))
+        fields = [ f.strip() for f in fields ]
+        if fields[0].lower() in _HEADERS:
+            continue
+        udid = fields[0]
+        name = fields[1] if len(fields) > 1 and fields[1] else udid
+        yield udid, name
+
+def read(filename):
+    with open(filename, 'rU') as f:
+        return list(parse(f))
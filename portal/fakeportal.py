@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# A local stand-in for the provisioning portal endpoints used by API, backed
+# by synthetic data, for offline testing and benchmarking:
+#
+#   python -m portal.fakeportal -p 8000 -D 10000 -P 2000
+#   PORTAL_BASE_URL=http://127.0.0.1:8000 PORTAL_CREDENTIALS=user:password \
+#       portal listDevices
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+import BaseHTTPServer
+import Cookie
+import getopt
+import httplib
+import json
+import plistlib
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import uuid
+
+SERVICES_PATH = '/services-developerportal/QH65B2/account/ios/'
+LOGIN_PATH = '/account/login.action'
+LOGIN_POST_PATH = '/account/authenticate.action'
+TEAM_ID_PATH = '/account/ios/certificate/certificateList.action'
+DOWNLOAD_PATH = '/account/ios/profile/profileContentDownload.action'
+
+CERT_TYPE_DEVELOPMENT = '5QPB9NHCEI'
+CERT_TYPE_DISTRIBUTION = 'R58UK2EWSO'
+
+_ALNUM = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+class FakePortal(object):
+    def __init__(self, devices=100, apps=20, profiles=40, certs=4, seed=0,
+            user='user', password='password', team_id='FAKETEAM01',
+            latency=0.0, error_rate=0.0):
+        self.user = user
+        self.password = password
+        self.team_id = team_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = set()
+        self._server = None
+        self.devices = [ self._make_device(i) for i in xrange(devices) ]
+        self.certs = [ self._make_cert(i) for i in xrange(certs) ]
+        self.apps = [ self._make_app(i) for i in xrange(apps) ]
+        self.profiles = []
+        for i in xrange(profiles):
+            app = self.apps[i % len(self.apps)] if self.apps else None
+            self._add_profile(self._make_profile(i, app))
+
+    # Data generation
+
+    def _id(self, length=10):
+        return ''.join(self._rng.choice(_ALNUM) for _ in xrange(length))
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self._rng.getrandbits(128), version=4))
+
+    def _make_device(self, i, udid=None, name=None):
+        return dict(deviceId=self._id(), name=name or 'Device %d' % i,
+            deviceNumber=udid or '%040x' % self._rng.getrandbits(160),
+            devicePlatform='ios', status='c', deviceClass='iphone')
+
+    def _make_cert(self, i):
+        typ = CERT_TYPE_DEVELOPMENT if i % 2 == 0 else CERT_TYPE_DISTRIBUTION
+        expires = (datetime(2030, 1, 1) +
+                   timedelta(days=self._rng.randint(0, 365)))
+        return dict(certRequestId=self._id(), certificateId=self._id(),
+            name='Cert %d' % i, certificateTypeDisplayId=typ,
+            typeString='iOS Development' if typ == CERT_TYPE_DEVELOPMENT
+                       else 'iOS Distribution',
+            statusString='Issued', dateRequested='2014-01-01',
+            dateCreated='2014-01-01', expirationDate=expires.strftime('%Y-%m-%d'),
+            serialNum=self._id(16), canDownload=True, canRevoke=True)
+
+    def _make_app(self, i):
+        return dict(appIdId=self._id(), name='App %d' % i, prefix=self.team_id,
+            identifier='com.example.app%d' % i if i else '*',
+            appIdPlatform='ios', isWildCard=i == 0, features=dict(
+                inAppPurchase=True, iCloud=False, gameCenter=True,
+                push=bool(i % 2), passbook=False, dataProtection=''))
+
+    def _make_profile(self, i, app, profile_type=None, name=None):
+        if profile_type is None:
+            profile_type = ('limited', 'adhoc', 'store')[i % 3]
+        if profile_type == 'limited':
+            certs = self._certs_of(CERT_TYPE_DEVELOPMENT)
+        else:
+            certs = self._certs_of(CERT_TYPE_DISTRIBUTION)
+        devices = [] if profile_type == 'store' else \
+                  [ d['deviceId'] for d in self.devices if d['status'] == 'c' ]
+        return dict(provisioningProfileId=self._id(),
+            name=name or '%s %s' % (app['name'], profile_type),
+            type='Development' if profile_type == 'limited' else 'Distribution',
+            distributionMethod=profile_type, proProPlatform='ios',
+            appId=app, deviceIds=devices, certificateIds=certs)
+
+    def _add_profile(self, profile):
+        self._regenerate(profile)
+        self.profiles.append(profile)
+        return profile
+
+    def _regenerate(self, profile):
+        expires = datetime(2030, 1, 1) + timedelta(days=self._rng.randint(0, 365))
+        profile.update(UUID=self._uuid(), status='Active',
+            dateExpire=expires.strftime('%Y-%m-%d'),
+            deviceCount=len(profile['deviceIds']),
+            certificateCount=len(profile['certificateIds']))
+
+    def _certs_of(self, typ):
+        return [ c['certificateId'] for c in self.certs
+                 if c['certificateTypeDisplayId'] == typ ]
+
+    def _find(self, items, key, value):
+        return next((i for i in items if i[key] == value), None)
+
+    def profile_content(self, profile):
+        devices = dict((d['deviceId'], d['deviceNumber']) for d in self.devices)
+        plist = dict(UUID=profile['UUID'], Name=profile['name'],
+            TeamIdentifier=[ self.team_id ],
+            AppIDName=profile['appId']['name'],
+            ExpirationDate=datetime.strptime(profile['dateExpire'], '%Y-%m-%d'),
+            Entitlements={ 'application-identifier': '%s.%s' % (
+                self.team_id, profile['appId']['identifier']) })
+        if profile['deviceIds']:
+            plist['ProvisionedDevices'] = [ devices[d]
+                for d in profile['deviceIds'] if d in devices ]
+        # Fake CMS envelope around the plist, as in real profiles
+        return '0\x80\x06\t*\x86H\x86\xf7\r\x01\x07\x02\xa0\x80' + \
+               plistlib.writePlistToString(plist) + '\x00' * 64
+
+    # Service endpoints, called with the lock held
+
+    def _listing(self, items, key, params, strip=()):
+        items = [ dict((k, v) for k, v in i.items() if k not in strip)
+                  for i in items ]
+        data = { key: items }
+        if 'pageSize' in params:
+            size = int(params['pageSize'])
+            page = int(params.get('pageNumber', 1))
+            data[key] = items[(page - 1) * size:page * size]
+            data.update(totalRecords=len(items), pageNumber=page,
+                        pageSize=size)
+        return data
+
+    def do_device_listDevices(self, params):
+        devices = self.devices
+        if params.get('includeRemovedDevices') == 'false':
+            devices = [ d for d in devices if d['status'] != 'r' ]
+        return self._listing(devices, 'devices', params)
+
+    def do_device_addDevice(self, params):
+        return dict(device=self._register(params.getall('deviceNumbers')[0],
+                                          params.getall('deviceNames')[0]))
+
+    def do_device_addDevices(self, params):
+        return dict(devices=[ self._register(udid, name) for udid, name in
+            zip(params.getall('deviceNumbers'), params.getall('deviceNames')) ])
+
+    def _register(self, udid, name):
+        device = self._find(self.devices, 'deviceNumber', udid)
+        if device is None:
+            device = self._make_device(len(self.devices), udid, name)
+            self.devices.append(device)
+        device['status'] = 'c'
+        return device
+
+    def do_device_deleteDevice(self, params):
+        device = self._find(self.devices, 'deviceId', params.get('deviceId'))
+        if device is None:
+            return self._error(35, 'Device not found')
+        device['status'] = 'r'
+        return {}
+
+    def do_device_enableDevice(self, params):
+        device = self._find(self.devices, 'deviceId', params.get('displayId'))
+        if device is None:
+            return self._error(35, 'Device not found')
+        device['status'] = 'c'
+        return dict(device=device)
+
+    def do_identifiers_listAppIds(self, params):
+        return self._listing(self.apps, 'appIds', params)
+
+    def do_certificate_listCertRequests(self, params):
+        types = params.get('types', '').split(',')
+        return self._listing([ c for c in self.certs
+            if c['certificateTypeDisplayId'] in types ], 'certRequests', params)
+
+    def do_profile_listProvisioningProfiles(self, params):
+        strip = ()
+        if params.get('onlyCountLists') == 'true':
+            strip = ('deviceIds', 'certificateIds')
+        return self._listing(self.profiles, 'provisioningProfiles', params,
+                             strip)
+
+    def do_profile_getProvisioningProfile(self, params):
+        profile = self._find(self.profiles, 'provisioningProfileId',
+                             params.get('provisioningProfileId'))
+        if profile is None:
+            return self._error(35, 'Profile not found')
+        devices = set(profile['deviceIds'])
+        certs = set(profile['certificateIds'])
+        return dict(provisioningProfile=dict(profile,
+            devices=[ d for d in self.devices if d['deviceId'] in devices ],
+            certificates=[ c for c in self.certs
+                           if c['certificateId'] in certs ]))
+
+    def do_profile_createProvisioningProfile(self, params):
+        app = self._find(self.apps, 'appIdId', params.get('appIdId'))
+        if app is None:
+            return self._error(35, 'App ID not found')
+        profile = self._make_profile(len(self.profiles), app,
+            params.get('distributionType'), params.get('provisioningProfileName'))
+        profile['certificateIds'] = _split_list(params.get('certificateIds'))
+        profile['deviceIds'] = _split_list(params.get('deviceIds'))
+        return dict(provisioningProfile=self._add_profile(profile))
+
+    def do_profile_regenProvisioningProfile(self, params):
+        profile = self._find(self.profiles, 'provisioningProfileId',
+                             params.get('provisioningProfileId'))
+        if profile is None:
+            return self._error(35, 'Profile not found')
+        profile.update(name=params.get('provisioningProfileName', profile['name']),
+            deviceIds=params.getall('deviceIds'),
+            certificateIds=params.getall('certificateIds'))
+        self._regenerate(profile)
+        return dict(provisioningProfile=profile)
+
+    def do_profile_deleteProvisioningProfile(self, params):
+        profile = self._find(self.profiles, 'provisioningProfileId',
+                             params.get('provisioningProfileId'))
+        if profile is None:
+            return self._error(35, 'Profile not found')
+        self.profiles.remove(profile)
+        return {}
+
+    def _error(self, code, message):
+        return dict(resultCode=code, resultString=message, userString=message)
+
+    # Server
+
+    def start(self, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), _Handler)
+        self._server.portal = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.base_url
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def handle(self, path, cookie, body):
+        # Answers a request, returning (code, headers, body)
+        url = urlparse.urlparse(path)
+        params = _Params(urlparse.parse_qsl(url.query) +
+                         urlparse.parse_qsl(body))
+        with self._lock:
+            self.requests += 1
+            error = self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        token = Cookie.SimpleCookie(cookie).get('myacinfo')
+        with self._lock:
+            session = token is not None and token.value in self._sessions
+        if url.path == LOGIN_PATH:
+            return _html('<form name="appleConnectForm" method="post" ' +
+                         'action="%s"></form>' % LOGIN_POST_PATH)
+        if url.path == LOGIN_POST_PATH:
+            if (params.get('theAccountName') != self.user or
+                    params.get('theAccountPW') != self.password):
+                return _html('Invalid credentials')
+            token = uuid.uuid4().hex
+            with self._lock:
+                self._sessions.add(token)
+            return _html('Welcome',
+                    [ ('Set-Cookie', 'myacinfo=%s; Path=/' % token) ])
+        if url.path == TEAM_ID_PATH:
+            if not session:
+                return _html('Please sign in')
+            return _html('<a href="?teamId=%s">Team</a>' % self.team_id)
+        if error:
+            return _text(503, 'Service Unavailable')
+        if url.path == DOWNLOAD_PATH:
+            if not session:
+                return _html('Please sign in')
+            with self._lock:
+                profile = self._find(self.profiles, 'provisioningProfileId',
+                                     params.get('displayId'))
+                content = profile and self.profile_content(profile)
+            if profile is None:
+                return _text(404, 'Not Found')
+            return 200, [ ('Content-Type', 'application/octet-stream') ], content
+        if not url.path.startswith(SERVICES_PATH):
+            return _text(404, 'Not Found')
+        if not session:
+            data = self._error(1100, 'Your session has expired')
+        else:
+            cmd = url.path[len(SERVICES_PATH):].replace('/', '_')
+            handler = getattr(self, 'do_%s' % cmd, None)
+            if handler is None:
+                return _text(404, 'Not Found')
+            with self._lock:
+                # Serialize while locked, the data is shared
+                body = json.dumps(dict(dict(resultCode=0), **handler(params)))
+            return 200, [ ('Content-Type', 'application/json') ], body
+        return 200, [ ('Content-Type', 'application/json') ], json.dumps(data)
+
+    def install(self, api):
+        # Route the requests of api to this portal in process
+        api._opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(api._cookie_jar), StubHandler(self))
+        return api
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self, host='127.0.0.1', port=0):
+        self._server = _Server((host, port), _Handler)
+        self._server.portal = self
+        self._server.serve_forever()
+
+class _Params(dict):
+    def __init__(self, pairs):
+        super(_Params, self).__init__(pairs)
+        self._pairs = pairs
+
+    def getall(self, key):
+        return [ v for k, v in self._pairs if k == key ]
+
+def _html(body, headers=()):
+    return 200, [ ('Content-Type', 'text/html') ] + list(headers), \
+           '<html>%s</html>' % body
+
+def _text(code, body):
+    return code, [ ('Content-Type', 'text/plain') ], body
+
+def _split_list(value):
+    value = (value or '').strip('[]')
+    return [ v for v in value.split(',') if v ]
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        code, headers, body = self.server.portal.handle(self.path,
+                self.headers.get('cookie', ''), body)
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubHandler(urllib2.BaseHandler):
+    # Serves urllib2 requests from a FakePortal in process, without sockets
+    handler_order = 100
+
+    def __init__(self, portal):
+        self.portal = portal
+
+    def http_open(self, req):
+        code, headers, body = self.portal.handle(req.get_selector(),
+                req.get_header('Cookie', ''), req.get_data() or '')
+        headers = httplib.HTTPMessage(StringIO(''.join('%s: %s\r\n' % h
+                for h in headers + [ ('Content-Length', len(body)) ])))
+        response = urllib.addinfourl(StringIO(body), headers,
+                req.get_full_url(), code)
+        response.msg = httplib.responses.get(code, '')
+        return response
+
+    https_open = http_open
+
+def main(argv=None):
+    optlist, args = getopt.getopt(argv or sys.argv[1:], 'h:p:D:A:P:C:s:l:e:')
+    opts = dict((o[1:], a) for o, a in optlist)
+    portal = FakePortal(devices=int(opts.get('D', 100)),
+        apps=int(opts.get('A', 20)), profiles=int(opts.get('P', 40)),
+        certs=int(opts.get('C', 4)), seed=int(opts.get('s', 0)),
+        latency=float(opts.get('l', 0)), error_rate=float(opts.get('e', 0)))
+    host, port = opts.get('h', '127.0.0.1'), int(opts.get('p', 8000))
+    print >>sys.stderr, 'Serving fake portal on http://%s:%d (%s:%s)' % (
+            host, port, portal.user, portal.password)
+    try:
+        portal.serve_forever(host, port)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789.eE+-'
+
+class _Reader(object):
+    def __init__(self, fp, chunk_size):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._eof = False
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected %s at offset %d, got %r' % (
+                ' or '.join(repr(ch) for ch in chars), self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number cut short by the chunk boundary still decodes (as
+                # 12 from "12" or "12.", say), so only trust values followed
+                # by something that cannot continue them (or at EOF)
+                if self._eof or (end < len(self.buf) and not (
+                        isinstance(value, (int, long, float)) and
+                        not isinstance(value, bool) and
+                        self.buf[end] in _NUMBER_CHARS)):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+def iter_array(fp, key, fields=None, chunk_size=64 * 1024):
+    # Yields the items of the top level array `key` of a JSON object read
+    # from fp, decoding one item at a time. Other top level members are
+    # stored in `fields` as they are found.
+    reader = _Reader(fp, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            value = reader.value()
+            if fields is not None:
+                fields[name] = value
+        if reader.expect(',}') == '}':
+            return
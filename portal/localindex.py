@@ -0,0 +1,198 @@
+# Index of the .mobileprovision files under a directory. New and changed
+# files are parsed by a pool of processes, the results kept next to them
+# in a JSON file keyed by path, mtime and size, so that later scans only
+# stat the tree.
+import json
+import os
+
+from . import mobileprovision
+
+# Keys of the embedded plists kept in the index
+KEYS = ('UUID Name AppIDName TeamIdentifier TeamName CreationDate ' +
+        'ExpirationDate ProvisionedDevices ProvisionsAllDevices ' +
+        'Entitlements').split()
+
+def _json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, dict):
+        return dict((k, _json_value(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [ _json_value(v) for v in value ]
+    if not isinstance(value, (basestring, int, long, float, bool)):
+        return None
+    return value
+
+def profile_type(embedded):
+    # Same names as API.profile_type_name, plus enterprise
+    entitlements = embedded.get('Entitlements') or {}
+    if entitlements.get('get-task-allow'):
+        return 'development'
+    if embedded.get('ProvisionsAllDevices'):
+        return 'enterprise'
+    if embedded.get('ProvisionedDevices'):
+        return 'adhoc'
+    return 'appstore'
+
+def read(filename):
+    # Index entry of a .mobileprovision file
+    embedded = mobileprovision.load(filename)
+    entry = dict((k, _json_value(embedded[k])) for k in KEYS if k in embedded)
+    entry['profileType'] = profile_type(embedded)
+    entitlements = embedded.get('Entitlements') or {}
+    entry['applicationIdentifier'] = entitlements.get('application-identifier')
+    return entry
+
+def _read(filename):
+    # Runs in the pool, errors are returned as they may not pickle. One
+    # odd file (say Entitlements not being a dict) must not end the scan.
+    try:
+        return filename, read(filename), None
+    except (IOError, ValueError) as e:
+        return filename, None, str(e)
+    except Exception as e:
+        return filename, None, '%s: %s' % (type(e).__name__, e)
+
+class ScanStats(object):
+    __slots__ = ('parsed', 'cached', 'removed', 'failed')
+
+    def __init__(self):
+        self.parsed = self.cached = self.removed = 0
+        self.failed = []
+
+    def __repr__(self):
+        return '<ScanStats parsed=%d cached=%d removed=%d failed=%d>' % (
+                self.parsed, self.cached, self.removed, len(self.failed))
+
+class LocalIndex(object):
+    FILENAME = '.portal-index.json'
+    EXTENSION = '.mobileprovision'
+    # Below that many files to parse, a pool costs more than it saves
+    MIN_POOL_FILES = 16
+
+    def __init__(self, path, filename=None):
+        self.path = path
+        self.filename = filename or os.path.join(path, self.FILENAME)
+        try:
+            with open(self.filename) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+        self._by_udid = None
+
+    def _files(self):
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                if name.lower().endswith(self.EXTENSION):
+                    yield os.path.join(dirpath, name)
+
+    def scan(self, jobs=None, callback=None):
+        # Brings the index up to date with the directory, parsing new or
+        # changed files jobs processes at a time (one per core by default).
+        # callback(filename, entry, error) is called for each parsed file.
+        stats = ScanStats()
+        entries = {}
+        pending = []
+        for filename in self._files():
+            relpath = os.path.relpath(filename, self.path)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entry = self._entries.get(relpath)
+            if (entry is not None and entry['mtime'] == st.st_mtime and
+                    entry['size'] == st.st_size):
+                entries[relpath] = entry
+                stats.cached += 1
+                # Still unreadable until changed
+                if 'error' in entry:
+                    stats.failed.append((filename, entry['error']))
+            else:
+                entries[relpath] = dict(mtime=st.st_mtime, size=st.st_size)
+                pending.append(filename)
+        stats.removed = len(set(self._entries) - set(entries))
+        for filename, profile, error in self._parse(pending, jobs):
+            entry = entries[os.path.relpath(filename, self.path)]
+            if error is not None:
+                entry['error'] = error
+                stats.failed.append((filename, error))
+            else:
+                entry['profile'] = profile
+                stats.parsed += 1
+            if callback:
+                callback(filename, profile, error)
+        self._entries = entries
+        self._by_udid = None
+        return stats
+
+    def _parse(self, filenames, jobs):
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        if jobs <= 1 or len(filenames) < self.MIN_POOL_FILES:
+            for filename in filenames:
+                yield _read(filename)
+            return
+        from multiprocessing import Pool, TimeoutError
+        pool = Pool(min(jobs, len(filenames)))
+        try:
+            # Chunks keep the round trips per file down
+            chunksize = max(1, min(64, len(filenames) / (jobs * 4)))
+            results = pool.imap_unordered(_read, filenames, chunksize)
+            while True:
+                try:
+                    # A timeout keeps the wait interruptible with ^C
+                    result = results.next(1)
+                except TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def save(self):
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f, separators=(',', ':'), sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def _profiles(self):
+        for relpath, entry in sorted(self._entries.iteritems()):
+            if 'profile' in entry:
+                profile = dict(entry['profile'])
+                profile['path'] = os.path.join(self.path, relpath)
+                yield relpath, profile
+
+    def profiles(self):
+        # Indexed profiles, each with the path of its file
+        return (profile for _, profile in self._profiles())
+
+    def query(self, udid=None, expires_before=None, app_id=None, team=None):
+        # Profiles containing the device udid, expiring before the date or
+        # datetime (ISO 8601 string), for the application identifier
+        # (without the team prefix) or of team
+        if udid is not None:
+            if self._by_udid is None:
+                self._by_udid = {}
+                for relpath, entry in self._entries.iteritems():
+                    for device in entry.get('profile', {}).get(
+                            'ProvisionedDevices') or ():
+                        self._by_udid.setdefault(device.lower(),
+                                                 set()).add(relpath)
+            relpaths = self._by_udid.get(udid.lower(), set())
+        for relpath, profile in self._profiles():
+            if udid is not None and relpath not in relpaths:
+                continue
+            if (expires_before is not None and
+                    profile.get('ExpirationDate', '') >= expires_before):
+                continue
+            if (app_id is not None and (profile.get('applicationIdentifier')
+                    or '').split('.', 1)[-1] != app_id):
+                continue
+            if team is not None and team not in (
+                    profile.get('TeamIdentifier') or ()):
+                continue
+            yield profile
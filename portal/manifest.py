@@ -0,0 +1,112 @@
+from datetime import datetime
+
+import json
+import os
+
+from . import mobileprovision
+
+class ProfileManifest(object):
+    FILENAME = '.portal-manifest.json'
+    KEYS = ('provisioningProfileId UUID dateExpire status deviceCount ' +
+            'certificateCount').split()
+    _DATE_FORMATS = ('%Y-%m-%d', '%b %d, %Y', '%Y-%m-%dT%H:%M:%SZ')
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.join(path, self.FILENAME)
+        try:
+            with open(self.filename) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+        # A file holds one profile, forget entries sharing one (written by
+        # older versions) so that the embedded UUID decides
+        owners = {}
+        for profile_id, entry in self._entries.items():
+            owners.setdefault(entry['filename'], []).append(profile_id)
+        for profile_ids in owners.values():
+            if len(profile_ids) > 1:
+                for profile_id in profile_ids:
+                    del self._entries[profile_id]
+        # Profile id by filename
+        self._owners = dict((entry['filename'], profile_id) for profile_id,
+                            entry in self._entries.items())
+
+    def _signature(self, profile):
+        return dict((k, profile.get(k)) for k in self.KEYS)
+
+    def _relpath(self, filename):
+        return os.path.relpath(filename, self.path)
+
+    def is_current(self, profile, filename):
+        if not os.path.isfile(filename):
+            return False
+        entry = self._entries.get(profile['provisioningProfileId'])
+        if entry is not None:
+            return (entry['filename'] == self._relpath(filename) and
+                    entry['signature'] == self._signature(profile))
+        if self._embedded_matches(profile, filename):
+            self.update(profile, filename)
+            return True
+        return False
+
+    def _embedded_matches(self, profile, filename):
+        if not profile.get('UUID'):
+            return False
+        try:
+            embedded = mobileprovision.load(filename)
+        except (IOError, ValueError):
+            return False
+        if embedded.get('UUID') != profile['UUID']:
+            return False
+        expires = _parse_date(profile.get('dateExpire'), self._DATE_FORMATS)
+        if expires and 'ExpirationDate' in embedded:
+            return expires.date() == embedded['ExpirationDate'].date()
+        return True
+
+    def update(self, profile, filename):
+        profile_id = profile['provisioningProfileId']
+        relpath = self._relpath(filename)
+        # The file no longer holds whichever profile it held before
+        previous = self._owners.get(relpath)
+        if previous not in (None, profile_id):
+            del self._entries[previous]
+        entry = self._entries.get(profile_id)
+        if entry is not None and self._owners.get(entry['filename']) == \
+                profile_id:
+            del self._owners[entry['filename']]
+        self._owners[relpath] = profile_id
+        self._entries[profile_id] = dict(filename=relpath,
+                signature=self._signature(profile))
+
+    def missing(self, profiles):
+        # Entries for profiles no longer in the portal whose file is still
+        # around, as (profile id, filename) pairs
+        ids = set(p['provisioningProfileId'] for p in profiles)
+        missing = []
+        for profile_id, entry in sorted(self._entries.items()):
+            if profile_id in ids:
+                continue
+            filename = os.path.join(self.path, entry['filename'])
+            if os.path.exists(filename):
+                missing.append((profile_id, filename))
+            else:
+                del self._entries[profile_id]
+                del self._owners[entry['filename']]
+        return missing
+
+    def save(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+def _parse_date(value, formats):
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return None
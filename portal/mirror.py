@@ -0,0 +1,280 @@
+# Local SQLite copy of a team's devices, app ids, provisioning profiles
+# (with their device ids) and certificates, for queries that need no
+# network. refresh() only writes rows that changed and marks those gone
+# from the portal as removed; profile details are only refetched for
+# profiles whose listing entry changed.
+from datetime import date, timedelta
+
+import json
+import re
+import sqlite3
+import time
+
+from .manifest import ProfileManifest, _parse_date
+from .records import Profile
+
+TABLES = ('devices', 'app_ids', 'profiles', 'certificates')
+# As given by API.profile_type_name
+PROFILE_TYPES = ('development', 'adhoc', 'appstore')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+CREATE TABLE IF NOT EXISTS devices (
+    id TEXT PRIMARY KEY,
+    udid TEXT,
+    name TEXT,
+    status TEXT,
+    data TEXT NOT NULL,
+    removed REAL);
+CREATE INDEX IF NOT EXISTS devices_udid ON devices (udid);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS app_ids (
+    id TEXT PRIMARY KEY,
+    identifier TEXT,
+    name TEXT,
+    data TEXT NOT NULL,
+    removed REAL);
+CREATE INDEX IF NOT EXISTS app_ids_identifier ON app_ids (identifier);
+CREATE TABLE IF NOT EXISTS profiles (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    status TEXT,
+    app_identifier TEXT,
+    expires TEXT,
+    details INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    removed REAL);
+CREATE INDEX IF NOT EXISTS profiles_name ON profiles (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS profiles_type ON profiles (type);
+CREATE INDEX IF NOT EXISTS profiles_app_identifier ON profiles (app_identifier);
+CREATE INDEX IF NOT EXISTS profiles_expires ON profiles (expires);
+CREATE TABLE IF NOT EXISTS profile_devices (
+    profile_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    PRIMARY KEY (profile_id, device_id));
+CREATE INDEX IF NOT EXISTS profile_devices_device ON profile_devices (device_id);
+CREATE TABLE IF NOT EXISTS certificates (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    expires TEXT,
+    data TEXT NOT NULL,
+    removed REAL);
+CREATE INDEX IF NOT EXISTS certificates_expires ON certificates (expires);
+'''
+
+class RefreshStats(object):
+    __slots__ = ('added', 'updated', 'removed', 'unchanged')
+
+    def __init__(self):
+        self.added = self.updated = self.removed = self.unchanged = 0
+
+    def __repr__(self):
+        return '<RefreshStats +%d ~%d -%d =%d>' % (self.added, self.updated,
+                self.removed, self.unchanged)
+
+def _iso_date(value):
+    parsed = _parse_date(value, ProfileManifest._DATE_FORMATS)
+    return parsed.date().isoformat() if parsed else None
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, value, re.I) is not None
+
+def _listing_data(record):
+    data = record.to_dict() if hasattr(record, 'to_dict') else dict(record)
+    for key in Profile.DETAILS:
+        data.pop(key, None)
+    return json.dumps(data, sort_keys=True)
+
+class Mirror(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.create_function('regexp', 2, _regexp)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               (key, )).fetchone()
+        return row[0] if row else None
+
+    @property
+    def team_id(self):
+        return self._meta('team_id')
+
+    @property
+    def refreshed(self):
+        value = self._meta('refreshed')
+        return float(value) if value else None
+
+    def refresh(self, api, jobs=8):
+        # Brings the mirror up to date with the portal, returning a
+        # RefreshStats per table
+        stats = {}
+        with self._db:
+            if self.team_id not in (None, api.team_id):
+                # Another team, start over
+                for table in TABLES + ('profile_devices', ):
+                    self._db.execute('DELETE FROM %s' % table)
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             ('team_id', api.team_id))
+            stats['devices'] = self._update('devices', api.all_devices(),
+                    lambda d: (d['deviceId'], d['deviceNumber'], d['name'],
+                               d.get('status')))
+            stats['app_ids'] = self._update('app_ids', api.all_app_ids(),
+                    lambda a: (a['appIdId'], a['identifier'], a['name']))
+            stats['certificates'] = self._update('certificates',
+                    api.all_cert_requests(),
+                    lambda c: (c['certificateId'], c.get('name'),
+                               c.get('typeString'),
+                               _iso_date(c.get('expirationDate'))))
+            profiles = api.all_provisioning_profiles()
+            stats['profiles'] = self._update('profiles', profiles,
+                    lambda p: (p['provisioningProfileId'], p['name'],
+                               api.profile_type_name(p), p.get('status'),
+                               p['appId']['identifier'],
+                               _iso_date(p.get('dateExpire'))))
+            self._update_profile_devices(api, profiles, jobs)
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             ('refreshed', repr(time.time())))
+        return stats
+
+    def _update(self, table, items, columns):
+        # columns(item) gives the id and the indexed columns of the table,
+        # in order
+        stats = RefreshStats()
+        info = [ r[1] for r in self._db.execute('PRAGMA table_info(%s)' %
+                 table) ]
+        names = [ n for n in info if n not in ('data', 'removed', 'details') ]
+        current = dict((r[0], (r[1], r[2])) for r in self._db.execute(
+                'SELECT id, data, removed FROM %s' % table))
+        insert = 'INSERT INTO %s (%s, data) VALUES (%s)' % (table,
+                ', '.join(names), ', '.join('?' * (len(names) + 1)))
+        # Changed profiles need their details fetched again
+        update = 'UPDATE %s SET %s, data = ?, removed = NULL%s WHERE id = ?' % (
+                table, ', '.join('%s = ?' % n for n in names[1:]),
+                ', details = 0' if 'details' in info else '')
+        seen = set()
+        for item in items:
+            values = columns(item)
+            data = _listing_data(item)
+            seen.add(values[0])
+            existing = current.get(values[0])
+            if existing is None:
+                self._db.execute(insert, values + (data, ))
+                stats.added += 1
+            elif existing[0] != data or existing[1] is not None:
+                self._db.execute(update, values[1:] + (data, values[0]))
+                if existing[1] is not None:
+                    stats.added += 1
+                else:
+                    stats.updated += 1
+            else:
+                stats.unchanged += 1
+        now = time.time()
+        for item_id, (_, removed) in current.iteritems():
+            if item_id not in seen and removed is None:
+                self._db.execute('UPDATE %s SET removed = ? WHERE id = ?' %
+                                 table, (now, item_id))
+                stats.removed += 1
+        return stats
+
+    def _update_profile_devices(self, api, profiles, jobs):
+        stale = set(r[0] for r in self._db.execute(
+                'SELECT id FROM profiles WHERE removed IS NULL AND '
+                'details = 0'))
+        pending = [ p for p in profiles if p['provisioningProfileId'] in stale ]
+        for profile in api.prefetch_profile_details(pending, jobs=jobs):
+            profile_id = profile['provisioningProfileId']
+            self._db.execute('DELETE FROM profile_devices WHERE profile_id = ?',
+                             (profile_id, ))
+            self._db.executemany('INSERT OR IGNORE INTO profile_devices '
+                    'VALUES (?, ?)', [ (profile_id, device_id)
+                    for device_id in profile['deviceIds'] ])
+            self._db.execute('UPDATE profiles SET details = 1 WHERE id = ?',
+                             (profile_id, ))
+
+    def device_id(self, device):
+        # Id of the device with the given id, UDID or name
+        row = self._db.execute('SELECT id FROM devices WHERE id = ? OR '
+                'udid = ? COLLATE NOCASE OR name = ? COLLATE NOCASE '
+                'ORDER BY removed IS NOT NULL LIMIT 1',
+                (device, device, device)).fetchone()
+        if row is None:
+            raise ValueError("Unknown device '%s'" % device)
+        return row[0]
+
+    def query(self, table, name=None, udid=None, identifier=None,
+            profile_type=None, expires_within=None, with_device=None,
+            without_device=None, removed=False):
+        # Rows of table as the dicts the portal returned, filtered by
+        # regexes on name and udid, app identifier, profile type, days to
+        # expiry and devices (by id, UDID or name) profiles include or lack.
+        # Profiles come with their profileType and deviceIds, once known.
+        if table not in TABLES:
+            raise ValueError("Unknown table '%s'" % table)
+        if profile_type is not None and profile_type not in PROFILE_TYPES:
+            raise ValueError("Invalid profile type '%s'" % profile_type)
+        for pattern in (name, udid):
+            try:
+                re.compile(pattern or '')
+            except re.error as e:
+                raise ValueError("Invalid regex '%s': %s" % (pattern, e))
+        where, params = [], []
+        def add(condition, *values):
+            where.append(condition)
+            params.extend(values)
+        columns = 'data'
+        if table == 'profiles':
+            columns += (', type, details, (SELECT group_concat(device_id) '
+                        'FROM profile_devices WHERE profile_id = profiles.id)')
+        if not removed:
+            add('removed IS NULL')
+        if name is not None:
+            add('name REGEXP ?', name)
+        if udid is not None:
+            add('udid REGEXP ?', udid)
+        if identifier is not None:
+            add('%s = ?' % ('identifier' if table == 'app_ids'
+                            else 'app_identifier'), identifier)
+        if profile_type is not None:
+            add('type = ?', profile_type)
+        if expires_within is not None:
+            add('expires <= ?', (date.today() +
+                timedelta(days=expires_within)).isoformat())
+        if with_device is not None:
+            add('id IN (SELECT profile_id FROM profile_devices WHERE '
+                'device_id = ?)', self.device_id(with_device))
+        if without_device is not None:
+            # App Store profiles never include devices
+            add("type != 'appstore' AND id NOT IN (SELECT profile_id FROM "
+                'profile_devices WHERE device_id = ?)',
+                self.device_id(without_device))
+        sql = 'SELECT %s FROM %s' % (columns, table)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY %s' % ('expires, name' if expires_within is not None
+                                 else 'name')
+        try:
+            cursor = self._db.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            raise ValueError(str(e))
+        for row in cursor:
+            data = json.loads(row[0])
+            if table == 'profiles':
+                data['profileType'] = row[1]
+                if row[2]:
+                    data['deviceIds'] = row[3].split(',') if row[3] else []
+            yield data
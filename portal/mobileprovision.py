@@ -0,0 +1,27 @@
+from xml.parsers.expat import ExpatError
+
+import plistlib
+
+_PLIST_START = '<?xml'
+_PLIST_END = '</plist>'
+
+def parse(data):
+    # The plist sits verbatim inside the CMS envelope, no need to verify
+    # the signature just to read it
+    start = data.find(_PLIST_START)
+    end = data.find(_PLIST_END, start)
+    if start < 0 or end < 0:
+        raise ValueError('No embedded plist found')
+    try:
+        return plistlib.readPlistFromString(data[start:end + len(_PLIST_END)])
+    except ExpatError as e:
+        raise ValueError('Invalid embedded plist: %s' % e)
+    except Exception as e:
+        # plistlib fails in all sorts of ways on malformed values (bad
+        # dates, base64 or integers)
+        raise ValueError('Invalid embedded plist: %s: %s' % (
+                type(e).__name__, e))
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return parse(f.read())
@@ -0,0 +1,148 @@
+# Writers for the list commands. Rows (records or dicts) are formatted as
+# they come and collected in a buffer, which goes to the stream in large
+# writes once full or once it held rows for a while (say while the next
+# page is fetched). Listings are never copied in memory.
+from collections import Mapping, OrderedDict
+
+import csv
+import json
+import threading
+import time
+
+FORMATS = ('text', 'repr', 'jsonl', 'csv', 'tsv')
+
+BUFFER_SIZE = 65536
+FLUSH_INTERVAL = 0.1
+
+def parse_columns(spec):
+    columns = [ c.strip() for c in spec.split(',') if c.strip() ]
+    if not columns:
+        raise ValueError('No columns given')
+    return columns
+
+def _plain(value):
+    if isinstance(value, Mapping):
+        return dict((k, _plain(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [ _plain(v) for v in value ]
+    return value
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (Mapping, list, tuple)):
+        return json.dumps(_plain(value))
+    return str(value)
+
+class Writer(object):
+    # text and tsv write tab separated columns, tsv and csv start with a
+    # header. repr and jsonl write whole rows unless columns were chosen.
+    # computed maps extra column names to functions of a row, other columns
+    # are keys or dotted paths into nested dicts ('appId.identifier').
+    def __init__(self, stream, format='text', columns=None, computed=None,
+            buffer_size=BUFFER_SIZE, interval=FLUSH_INTERVAL):
+        if format not in FORMATS:
+            raise ValueError("Unknown format '%s'" % format)
+        if columns is None and format not in ('repr', 'jsonl'):
+            raise ValueError('%s needs columns' % format)
+        self.stream = stream
+        self.format = format
+        self.columns = columns
+        self.computed = computed or {}
+        self.buffer_size = buffer_size
+        # Rows show up right away when someone is watching
+        isatty = getattr(stream, 'isatty', None)
+        self.interval = 0 if isatty and isatty() else interval
+        self._chunks = []
+        self._size = 0
+        self._buffered = None
+        self._lock = threading.Condition()
+        self._timer = None
+        self._closed = False
+        self._csv = csv.writer(self, lineterminator='\n') \
+                if format == 'csv' else None
+        if format in ('csv', 'tsv'):
+            self._write_fields(columns)
+
+    def value(self, row, column):
+        fn = self.computed.get(column)
+        if fn is not None:
+            return fn(row)
+        value = row
+        for key in column.split('.'):
+            if not isinstance(value, Mapping):
+                return None
+            value = value.get(key)
+        return value
+
+    def writerow(self, row):
+        if self.format in ('repr', 'jsonl'):
+            if self.columns is not None:
+                row = OrderedDict((c, _plain(self.value(row, c)))
+                                  for c in self.columns)
+            elif self.format == 'jsonl':
+                row = _plain(row)
+            self.write('%s\n' % (json.dumps(row) if self.format == 'jsonl'
+                                 else repr(row)))
+        else:
+            self._write_fields([ self.value(row, c) for c in self.columns ])
+
+    def _write_fields(self, values):
+        fields = [ _text(v) for v in values ]
+        if self._csv is not None:
+            self._csv.writerow(fields)
+        else:
+            if self.format == 'tsv':
+                fields = [ f.replace('\t', ' ').replace('\n', ' ')
+                           for f in fields ]
+            self.write('%s\n' % '\t'.join(fields))
+
+    def write(self, data):
+        with self._lock:
+            if not self._chunks:
+                self._buffered = time.time()
+            self._chunks.append(data)
+            self._size += len(data)
+            if self._size < self.buffer_size and self.interval:
+                if self._timer is None:
+                    self._timer = threading.Thread(target=self._flush_later)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._flush()
+
+    def _flush_later(self):
+        # Flushes rows left waiting for interval, until closed
+        with self._lock:
+            while not self._closed:
+                self._lock.wait(self.interval)
+                if (self._chunks and
+                        time.time() - self._buffered >= self.interval):
+                    self._flush()
+
+    def _flush(self):
+        if self._chunks:
+            self.stream.write(''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+        self.stream.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+            self._flush()
+        if self._timer is not None:
+            self._timer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
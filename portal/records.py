@@ -0,0 +1,243 @@
+from collections import Mapping
+
+PROFILE_TYPE_DEVELOPMENT = 0
+PROFILE_TYPE_ADHOC = 1
+PROFILE_TYPE_APPSTORE = 2
+
+class Record(object):
+    # Compact stand-in for the JSON dicts returned by the portal. Known keys
+    # live in slots, anything else in _extra. Reads like a dict.
+    __slots__ = ('_extra',)
+    _FIELDS = frozenset()
+    _NESTED = {}
+
+    def __init__(self, data):
+        extra = None
+        for key, value in data.iteritems():
+            if key in self._FIELDS:
+                nested = self._NESTED.get(key)
+                if nested is not None and isinstance(value, dict):
+                    value = nested(value)
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                delattr(self, key)
+                return
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+            return
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    _MISSING = object()
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is self._MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs, ):
+            pairs = other.items() if hasattr(other, 'items') else other
+            for key, value in pairs:
+                self[key] = value
+
+    def __contains__(self, key):
+        # What the record holds, without loading anything (see Profile)
+        if key in self._FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def keys(self):
+        keys = [ k for k in self.__slots__ if k in self._FIELDS and
+                 hasattr(self, k) ]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [ (k, self[k]) for k in self.keys() ]
+
+    def values(self):
+        return [ self[k] for k in self.keys() ]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def to_dict(self):
+        return dict((k, v.to_dict() if isinstance(v, Record) else v)
+                    for k, v in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # Slots rule out the default pickling, pickle the data instead
+        return type(self), (self.to_dict(), )
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+Mapping.register(Record)
+
+class Device(Record):
+    __slots__ = ('deviceId name deviceNumber devicePlatform status ' +
+            'deviceClass model').split()
+    _FIELDS = frozenset(__slots__)
+
+class AppId(Record):
+    __slots__ = ('appIdId name appIdPlatform prefix identifier isWildCard ' +
+            'isDuplicate features enabledFeatures isDevPushEnabled ' +
+            'isProdPushEnabled associatedApplicationGroupsCount ' +
+            'associatedCloudContainersCount associatedIdentifiersCount').split()
+    _FIELDS = frozenset(__slots__)
+
+class Profile(Record):
+    __slots__ = ('provisioningProfileId name status type distributionMethod ' +
+            'proProPlatform version dateExpire managingApp appId appIdId ' +
+            'deviceCount certificateCount deviceIds certificateIds ' +
+            'devices certificates UUID').split() + [ '_profile_type', '_loader' ]
+    _FIELDS = frozenset(__slots__[:-2])
+    _NESTED = dict(appId=AppId)
+    # Left out of the listings, which only count devices and certificates.
+    # Reading one (profile['deviceIds'], profile.get('deviceIds')) fetches
+    # them from the portal when a loader is set; `in` only tells whether
+    # they are loaded already.
+    DETAILS = ('deviceIds', 'certificateIds', 'devices', 'certificates')
+
+    def __init__(self, data):
+        super(Profile, self).__init__(data)
+        self._profile_type = None
+        self._loader = None
+
+    def __getitem__(self, key):
+        try:
+            return super(Profile, self).__getitem__(key)
+        except KeyError:
+            if key not in self.DETAILS or not self.load_details():
+                raise
+            return super(Profile, self).__getitem__(key)
+
+    @property
+    def has_details(self):
+        return hasattr(self, 'deviceIds') and hasattr(self, 'certificateIds')
+
+    def set_loader(self, loader):
+        # loader(profile) fetches the details, on first access to one of them
+        if not self.has_details:
+            self._loader = loader
+
+    def load_details(self):
+        # Another thread may be loading them as well, the loader is only
+        # dropped once the details are in
+        loader = self._loader
+        if loader is not None:
+            self.update_details(loader(self))
+            self._loader = None
+        return self.has_details
+
+    def update_details(self, details):
+        for key in self.DETAILS:
+            if key in details:
+                self[key] = details[key]
+        for key, objects, object_key in (
+                ('deviceIds', 'devices', 'deviceId'),
+                ('certificateIds', 'certificates', 'certificateId')):
+            if not hasattr(self, key):
+                self[key] = [ o[object_key] for o in
+                              getattr(self, objects, None) or () ]
+
+    def __setitem__(self, key, value):
+        super(Profile, self).__setitem__(key, value)
+        if key in ('type', 'deviceCount'):
+            self._profile_type = None
+
+    @property
+    def profile_type(self):
+        if self._profile_type is None:
+            self._profile_type = profile_type(self)
+        return self._profile_type
+
+class CertRequest(Record):
+    __slots__ = ('certRequestId name statusString dateRequestedString ' +
+            'dateRequested dateCreated expirationDate expirationDateString ' +
+            'ownerType ownerName ownerId canDownload canRevoke ' +
+            'certificateId certificateStatusCode certRequestStatusCode ' +
+            'certificateTypeDisplayId serialNum typeString').split()
+    _FIELDS = frozenset(__slots__)
+
+def profile_type(profile):
+    if profile['type'] == 'Development':
+        return PROFILE_TYPE_DEVELOPMENT
+    if profile['deviceCount']:
+        return PROFILE_TYPE_ADHOC
+    return PROFILE_TYPE_APPSTORE
+
+def wrap(cls, items):
+    return [ i if isinstance(i, cls) else cls(i) for i in items ]
@@ -0,0 +1,130 @@
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+
+def classify(error):
+    # THROTTLED when the portal turned the request away, TRANSIENT when it
+    # may have failed on the way, None when retrying won't help
+    if isinstance(error, urllib2.HTTPError):
+        if error.code in (429, 503):
+            return THROTTLED
+        if error.code in (500, 502, 504):
+            return TRANSIENT
+        return None
+    if isinstance(error, (urllib2.URLError, httplib.HTTPException,
+                          socket.error)):
+        return TRANSIENT
+    return None
+
+class Scheduler(object):
+    # Admits requests to the portal. Concurrency adapts AIMD style: it grows
+    # by one per window of fast successes and halves on throttling, errors
+    # or latency well above the best seen. An optional token bucket caps
+    # the request rate. Waiting reads go before waiting writes.
+    LATENCY_FACTOR = 4
+    MIN_LATENCY_THRESHOLD = 0.25
+
+    def __init__(self, concurrency=8, max_concurrency=32, rate=None,
+            burst=None, retries=3, backoff=0.5, max_delay=30):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.retries = retries
+        self.backoff = backoff
+        # Longest wait before a retry, longer Retry-After values give up
+        self.max_delay = max_delay
+        self._window = float(min(concurrency, max_concurrency))
+        self._active = 0
+        self._waiting_reads = 0
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._refilled = time.time()
+        self._baseline = None
+        self._decreased = 0
+
+    @property
+    def concurrency(self):
+        return int(self._window)
+
+    def acquire(self, write=False):
+        with self._cond:
+            if not write:
+                self._waiting_reads += 1
+            try:
+                while (self._active >= int(self._window) or
+                       (write and self._waiting_reads)):
+                    # With a timeout so that Ctrl-C still gets through
+                    self._cond.wait(1)
+            finally:
+                if not write:
+                    self._waiting_reads -= 1
+            self._active += 1
+        if self.rate:
+            self._take_token()
+
+    def _take_token(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, latency, error=None):
+        with self._cond:
+            self._active -= 1
+            if error is not None:
+                if classify(error) is not None:
+                    self._decrease(latency)
+            elif self._is_slow(latency):
+                self._decrease(latency)
+            else:
+                self._window = min(self.max_concurrency,
+                                   self._window + 1 / self._window)
+            self._cond.notify_all()
+
+    def _is_slow(self, latency):
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        else:
+            # Let the baseline follow the portal if it gets slower for good
+            self._baseline += (latency - self._baseline) * 0.01
+        return latency > max(self._baseline * self.LATENCY_FACTOR,
+                             self.MIN_LATENCY_THRESHOLD)
+
+    def _decrease(self, latency):
+        # Once per round trip, requests in flight report the same congestion
+        now = time.time()
+        if now - self._decreased < latency:
+            return
+        self._decreased = now
+        self._window = max(1.0, self._window / 2)
+
+    def retry_delay(self, error, write, attempt):
+        # Seconds to wait before retrying, None to give up. Writes are only
+        # retried when the portal refused them, not when they may have been
+        # carried out.
+        kind = classify(error)
+        if (attempt >= self.retries or kind is None or
+                (write and kind != THROTTLED)):
+            return None
+        if isinstance(error, urllib2.HTTPError):
+            try:
+                delay = max(0.0, float((error.hdrs or {}).get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+            else:
+                return delay if delay <= self.max_delay else None
+        return min(self.max_delay,
+                   self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
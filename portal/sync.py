@@ -0,0 +1,188 @@
+# Reconciles the provisioning profiles of a team with a manifest such as
+#
+#   {
+#     "profiles": [
+#       { "app_id": "com.example.app", "type": "adhoc" },
+#       { "app_id": "com.example.app", "type": "development",
+#         "name": "Example Dev", "devices": { "name": "^QA " } },
+#       { "app_id": "*", "type": "development",
+#         "certificates": [ "CERTID" ], "devices": [ "udid or id", ... ] }
+#     ],
+#     "delete_unmanaged": false
+#   }
+#
+# devices defaults to every enabled device (none for appstore profiles) and
+# may be a list of device ids and UDIDs or regexes on name and udid.
+# certificates defaults to every certificate of the profile's kind.
+import json
+import re
+
+from . import records
+
+KEEP = 'keep'
+CREATE = 'create'
+REGENERATE = 'regenerate'
+DELETE = 'delete'
+
+_ENTRY_KEYS = frozenset('app_id type name devices certificates'.split())
+_DEVICE_FILTER_KEYS = frozenset(('name', 'udid'))
+
+class Change(object):
+    # One step of a plan. devices and certificates are the desired id lists,
+    # the added_*/removed_* sets what that changes on the portal.
+    __slots__ = ('action profile app_id profile_type name devices ' +
+            'certificates added_devices removed_devices ' +
+            'added_certificates removed_certificates reason').split()
+
+    def __init__(self, action, profile=None, app_id=None, profile_type=None,
+            name=None, devices=(), certificates=(), current_devices=(),
+            current_certificates=(), reason=None):
+        self.action = action
+        self.profile = profile
+        self.app_id = app_id
+        self.profile_type = profile_type
+        self.name = name
+        self.devices = list(devices)
+        self.certificates = list(certificates)
+        self.added_devices = set(devices) - set(current_devices)
+        self.removed_devices = set(current_devices) - set(devices)
+        self.added_certificates = set(certificates) - set(current_certificates)
+        self.removed_certificates = set(current_certificates) - set(certificates)
+        self.reason = reason
+
+    def __repr__(self):
+        return '<Change %s %s>' % (self.action,
+                self.profile['provisioningProfileId'] if self.profile
+                else self.name)
+
+def load(filename):
+    with open(filename) as f:
+        try:
+            manifest = json.load(f)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (filename, e))
+    validate(manifest)
+    return manifest
+
+def validate(manifest):
+    if not isinstance(manifest, dict) or \
+            not isinstance(manifest.get('profiles'), list):
+        raise ValueError('Manifest needs a "profiles" list')
+    for entry in manifest['profiles']:
+        if not isinstance(entry, dict) or 'app_id' not in entry or \
+                'type' not in entry:
+            raise ValueError('Profile entries need "app_id" and "type": %r' %
+                    (entry, ))
+        unknown = set(entry) - _ENTRY_KEYS
+        if unknown:
+            raise ValueError('Unknown profile keys: %s' %
+                    ', '.join(sorted(unknown)))
+        devices = entry.get('devices', 'all')
+        if isinstance(devices, dict):
+            if set(devices) - _DEVICE_FILTER_KEYS:
+                raise ValueError('Device filters are "name" and "udid": %r' %
+                        (devices, ))
+        elif devices != 'all' and not isinstance(devices, list):
+            raise ValueError('Invalid devices: %r' % (devices, ))
+        certificates = entry.get('certificates', 'all')
+        if certificates != 'all' and not isinstance(certificates, list):
+            raise ValueError('Invalid certificates: %r' % (certificates, ))
+
+def _desired_devices(api, entry, profile_type):
+    if profile_type == records.PROFILE_TYPE_APPSTORE:
+        return []
+    devices = entry.get('devices', 'all')
+    if isinstance(devices, list):
+        found = api.get_device(devices, return_id_if_missing=True)
+        missing = [ d for d in found if isinstance(d, basestring) ]
+        if missing:
+            raise ValueError('Unknown devices: %s' % ', '.join(missing))
+        return [ d['deviceId'] for d in found ]
+    devices_filter = devices if isinstance(devices, dict) else {}
+    def match(device):
+        return (device.get('status') != 'r' and
+                ('name' not in devices_filter or re.search(
+                    devices_filter['name'], device['name'], re.I)) and
+                ('udid' not in devices_filter or re.search(
+                    devices_filter['udid'], device['deviceNumber'], re.I)))
+    return [ d['deviceId'] for d in api.all_devices() if match(d) ]
+
+def _desired_certificates(api, entry, profile_type):
+    certificates = entry.get('certificates', 'all')
+    if isinstance(certificates, list):
+        return list(certificates)
+    if profile_type == records.PROFILE_TYPE_DEVELOPMENT:
+        typ = api.CERT_TYPE_IOS_DEVELOPMENT
+    else:
+        typ = api.CERT_TYPE_IOS_DISTRIBUTION
+    return [ c['certificateId'] for c in api.list_cert_requests(typ) ]
+
+def plan(api, manifest, jobs=1):
+    validate(manifest)
+    changes = []
+    managed = set()
+    candidates = []
+    for entry in manifest['profiles']:
+        app_id = api.get_app_id(entry['app_id'])
+        if app_id is None:
+            raise ValueError("Unknown app id '%s'" % entry['app_id'])
+        profile_type = api.profile_type(entry['type'])
+        name = entry.get('name') or '%s %s' % (app_id['name'],
+                'Development AdHoc AppStore'.split()[profile_type])
+        devices = _desired_devices(api, entry, profile_type)
+        certificates = _desired_certificates(api, entry, profile_type)
+        existing = api.find_provisioning_profiles(app_id, profile_type)
+        if entry.get('name'):
+            existing = [ p for p in existing if p['name'] == name ]
+        existing = [ p for p in existing
+                     if p['provisioningProfileId'] not in managed ]
+        if not existing:
+            changes.append(Change(CREATE, None, app_id, profile_type, name,
+                    devices, certificates, reason='missing'))
+            continue
+        profile = existing[0]
+        managed.add(profile['provisioningProfileId'])
+        # The default name is only for new profiles, existing ones keep
+        # theirs unless the manifest names them
+        candidates.append((profile, app_id, profile_type,
+                           entry.get('name') or profile['name'], devices,
+                           certificates))
+    # Only the details have the device and certificate ids, fetch those
+    # of all candidates at once
+    api.prefetch_profile_details([ c[0] for c in candidates ], jobs=jobs)
+    for profile, app_id, profile_type, name, devices, certificates in \
+            candidates:
+        change = Change(KEEP, profile, app_id, profile_type, name, devices,
+                certificates, profile['deviceIds'], profile['certificateIds'])
+        reasons = []
+        if profile['status'] != 'Active':
+            reasons.append(profile['status'].lower())
+        if profile['name'] != name:
+            reasons.append('renamed')
+        if change.added_devices or change.removed_devices:
+            reasons.append('devices')
+        if change.added_certificates or change.removed_certificates:
+            reasons.append('certificates')
+        if reasons:
+            change.action = REGENERATE
+            change.reason = ', '.join(reasons)
+        changes.append(change)
+    if manifest.get('delete_unmanaged'):
+        for profile in api.all_provisioning_profiles():
+            if profile['provisioningProfileId'] not in managed:
+                changes.append(Change(DELETE, profile,
+                        profile['appId'], api.profile_type(profile),
+                        profile['name'], reason='unmanaged'))
+    return changes
+
+def apply_change(api, change):
+    if change.action == CREATE:
+        return api.create_provisioning_profile(change.profile_type,
+                change.app_id, certificates=change.certificates,
+                devices=change.devices, name=change.name)
+    if change.action == REGENERATE:
+        return api.update_provisioning_profile(change.profile,
+                name=change.name, certificate_ids=change.certificates,
+                device_ids=change.devices)
+    if change.action == DELETE:
+        return api.delete_provisioning_profile(change.profile)
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+
+class Event(object):
+    # One exchange with the portal (kind 'api', 'login' or 'download') or a
+    # listing lookup (kind 'cache'). latency is in seconds; for streamed
+    # responses it lasts until the response was read through.
+    __slots__ = ('kind endpoint start latency request_bytes response_bytes ' +
+            'result_code cached error thread').split()
+
+    def __init__(self, kind, endpoint, start, latency, request_bytes=0,
+            response_bytes=0, result_code=None, cached=False, error=None):
+        self.kind = kind
+        self.endpoint = endpoint
+        self.start = start
+        self.latency = latency
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        self.result_code = result_code
+        self.cached = cached
+        self.error = error
+        self.thread = threading.current_thread().ident
+
+    def to_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __repr__(self):
+        return 'Event(%r)' % self.to_dict()
+
+class MeteredResponse(object):
+    # Counts the bytes read from a response and reports them once closed
+    def __init__(self, response, report):
+        self._response = response
+        self._report = report
+        self.size = 0
+        self.result_code = None
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self._response.close()
+        report, self._report = self._report, None
+        if report is not None:
+            report(self)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _format_bytes(size):
+    for unit in ('B', 'K', 'M'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fG' % size
+
+class LatencyStats(object):
+    # API hook keeping latencies per endpoint, for summary()
+    BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+
+    def __call__(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def summary(self):
+        with self._lock:
+            events = list(self._events)
+        if not events:
+            return 'No requests'
+        groups = {}
+        for event in events:
+            groups.setdefault((event.kind, event.endpoint), []).append(event)
+        lines = [ '%-44s %6s %6s %7s %8s %8s %8s %8s %9s' % ('endpoint',
+                'count', 'errors', 'bytes', 'p50', 'p90', 'p99', 'max',
+                'total') ]
+        for (kind, endpoint), group in sorted(groups.items(),
+                key=lambda g: -sum(e.latency for e in g[1])):
+            latencies = sorted(e.latency for e in group)
+            errors = len([ e for e in group if e.error or
+                           e.result_code not in (None, 0, 8500) ])
+            cached = len([ e for e in group if e.cached ])
+            name = '%s %s' % (kind, endpoint)
+            if cached:
+                name += ' (%d cached)' % cached
+            lines.append('%-44s %6d %6d %7s %7.1fms %7.1fms %7.1fms %7.1fms %8.2fs' % (
+                name[:44], len(group), errors,
+                _format_bytes(sum(e.response_bytes for e in group)),
+                _percentile(latencies, 0.5) * 1000,
+                _percentile(latencies, 0.9) * 1000,
+                _percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000, sum(latencies)))
+        counts = [ 0 ] * (len(self.BUCKETS) + 1)
+        for event in events:
+            counts[len([ b for b in self.BUCKETS if event.latency >= b ])] += 1
+        lines.append('')
+        widest = max(counts)
+        labels = [ '< %gms' % (self.BUCKETS[0] * 1000) ] + [
+                   '>= %gms' % (b * 1000) if b < 1 else '>= %gs' % b
+                   for b in self.BUCKETS ]
+        for label, count in zip(labels, counts):
+            if count:
+                lines.append('%10s |%-40s %d' % (label,
+                        '#' * max(1, count * 40 / widest), count))
+        return '\n'.join(lines)
+
+class ChromeTrace(object):
+    # API hook collecting events in the Chrome trace event format, for
+    # chrome://tracing or https://ui.perfetto.dev
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._pid = os.getpid()
+
+    def __call__(self, event):
+        args = dict(request_bytes=event.request_bytes,
+                    response_bytes=event.response_bytes)
+        for key in ('result_code', 'cached', 'error'):
+            if getattr(event, key):
+                args[key] = getattr(event, key)
+        with self._lock:
+            self._events.append(dict(name=event.endpoint, cat=event.kind,
+                ph='X', ts=int(event.start * 1e6),
+                dur=int(event.latency * 1e6), pid=self._pid,
+                tid=event.thread, args=args))
+
+    def write(self, filename):
+        with self._lock:
+            events = list(self._events)
+        with open(filename, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
@@ -0,0 +1,142 @@
+import httplib
+import select
+import socket
+import threading
+import urllib
+import urllib2
+
+_IDEMPOTENT = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+def _dropped(conn):
+    # An idle connection has nothing to read unless the server closed it
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([ conn.sock ], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class ConnectionPool(object):
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                if not conns:
+                    break
+                conn = conns.pop()
+            if not _dropped(conn):
+                return conn, True
+            conn.close()
+        return factory(), False
+
+    def put(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+class _PooledSocket(object):
+    # Quacks like the socket socket._fileobject expects, handing the
+    # connection back to the pool once the body has been fully read
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+
+    def recv(self, amt):
+        if self._response is None:
+            return ''
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._finish(True)
+        return data
+
+    def close(self):
+        if self._response is not None:
+            # Unread data left on the wire, the connection can't be reused
+            self._response.close()
+            self._finish(False)
+
+    def _finish(self, reusable):
+        self._response = None
+        self._release(reusable)
+
+class _PooledHandlerMixin(object):
+    def _pooled_open(self, conn_class, req, **kwargs):
+        if getattr(req, '_tunnel_host', None):
+            return self.do_open(conn_class, req, **kwargs)
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((k.title(), v) for k, v in headers.items())
+        key = conn_class, host
+        factory = lambda: conn_class(host, timeout=req.timeout, **kwargs)
+        method = req.get_method()
+        while True:
+            conn, reused = self._pool.get(key, factory)
+            # The server may have dropped an idle keep-alive connection. A
+            # request that could not be sent is tried again on a new one,
+            # as is a read without response; a write may have been carried
+            # out, so its caller decides.
+            try:
+                conn.request(method, req.get_selector(), req.data, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+                continue
+            try:
+                r = conn.getresponse(buffering=True)
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused or method not in _IDEMPOTENT:
+                    raise urllib2.URLError(e)
+        def release(reusable):
+            if reusable:
+                self._pool.put(key, conn)
+            else:
+                conn.close()
+        fp = socket._fileobject(_PooledSocket(r, release), close=True)
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+class PooledHTTPHandler(_PooledHandlerMixin, urllib2.HTTPHandler):
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self._pool = pool
+
+    def http_open(self, req):
+        return self._pooled_open(httplib.HTTPConnection, req)
+
+class PooledHTTPSHandler(_PooledHandlerMixin, urllib2.HTTPSHandler):
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self._pool = pool
+
+    def https_open(self, req):
+        kwargs = {}
+        if getattr(self, '_context', None) is not None:
+            kwargs['context'] = self._context
+        return self._pooled_open(httplib.HTTPSConnection, req, **kwargs)
+
+def pooled_handlers(pool):
+    return PooledHTTPHandler(pool), PooledHTTPSHandler(pool)
@@ -26,7 +26,7 @@ setup(
     include_package_data=True,
     entry_points=dict(
       console_scripts=[
-        'portal = portal.cli:main'
+        'portal = portal.cli:console_main'
       ],
     ),
     classifiers=[